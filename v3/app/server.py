@@ -1,20 +1,32 @@
 import asyncio
 import cProfile
+import multiprocessing
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from app.world import run_bots_continuous, stop_bots
+from app.shared_frames import SharedFrames
+from app.world import create_frames, run_bots_continuous
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import Response
 from starlette.types import Scope
 
-latest_bot_states = {}
-# Global task variable to keep track of the running simulation
-current_simulation_task = None
+context = multiprocessing.get_context("spawn")
+# The simulation runs in its own process, so it never holds up the handlers,
+# and commits its frames to shared memory, where they read the latest one.
+frames: Optional[SharedFrames] = None
+current_simulation_process = None
+stop_simulation = context.Event()
 use_profiler = False
 
 
+def latest_bot_states() -> dict:
+    if frames is None:
+        return {}
+    return frames.read_frames()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     if use_profiler:
@@ -57,33 +69,41 @@ async def root():
 @app.get("/start")
 async def start(n: int = 10):
     print("/start")
-    global current_simulation_task
-    if current_simulation_task:
+    global current_simulation_process, frames
+    if current_simulation_process:
         return {"message": "Simulation already running"}
 
     bot_opts = {"width": 10, "height": 10}
-    current_simulation_task = asyncio.create_task(
-        run_bots_continuous(n, latest_bot_states, bot_opts=bot_opts)
+    frames = create_frames(n, bot_opts)
+    stop_simulation.clear()
+    current_simulation_process = context.Process(
+        target=run_bots_continuous,
+        args=(n, bot_opts, frames.spec(), stop_simulation),
     )
+    current_simulation_process.start()
     return {"message": f"Started {n} bots"}
 
 
 @app.get("/stop")
 async def stop():
     print("/stop")
-    await stop_bots()
+    stop_simulation.set()
 
-    global current_simulation_task
-    if current_simulation_task:
-        current_simulation_task.cancel()  # Cancel the current simulation task
-        current_simulation_task = None
+    global current_simulation_process, frames
+    if current_simulation_process:
+        # the simulation finishes its loop first, so wait without blocking
+        await asyncio.to_thread(current_simulation_process.join)
+        current_simulation_process = None
+    if frames:
+        frames, stopped_frames = None, frames
+        stopped_frames.close()
 
     return {"message": "Stopped all bots"}
 
 
 @app.get("/state")
 async def state():
-    return {"message": "Latest bot states", "latest_bot_states": latest_bot_states}
+    return {"message": "Latest bot states", "latest_bot_states": latest_bot_states()}
 
 
 @app.websocket("/ws")
@@ -94,7 +114,7 @@ async def websocket_endpoint(websocket: WebSocket):
             data = await websocket.receive_text()
             if data == "tick":
                 # print("tick")
-                await manager.send(latest_bot_states, websocket)
+                await manager.send(latest_bot_states(), websocket)
             else:
                 pass
 
@@ -0,0 +1,142 @@
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Slots in the ring. The bot processes write one slot per event, so a reader
+# has RING_SIZE - 1 events to copy the last committed slot before it's reused.
+RING_SIZE = 4
+# Grid cells are 0 (empty), 1 (piece in play) or a locked piece's type.
+CELL_VALUES = [0, 1, "I", "J", "L", "O", "S", "T", "Z"]
+CELL_CODES = {value: code for code, value in enumerate(CELL_VALUES)}
+
+
+class SharedFrames:
+    """The bots' render state and genomes, in one block of shared memory.
+
+    The render state of every event goes into the next slot of a ring, and the
+    slot is committed once every bot process has written its rows, so readers
+    only ever see whole events. The genomes are a flat float32 vector per bot
+    (see TetrisBrain.to_vector), for the bot processes to find their parents
+    in each other's bots.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        width: int,
+        height: int,
+        parameter_count: int,
+        name: Optional[str] = None,
+    ):
+        """Allocate a new block, or attach to the block with this name."""
+        self.size = size
+        self.width = width
+        self.height = height
+        self.parameter_count = parameter_count
+
+        self.fields = [
+            # committed event number, loop count and event count
+            ("header", np.int64, (3,)),
+            ("grids", np.int8, (RING_SIZE, size, height, width)),
+            ("scores", np.int64, (RING_SIZE, size)),
+            ("game_over", np.bool_, (RING_SIZE, size)),
+            ("fitness", np.int64, (RING_SIZE, size)),
+            ("genomes", np.float32, (size, parameter_count)),
+        ]
+        offsets = []
+        nbytes = 0
+        for _field, dtype, shape in self.fields:
+            # keep every array 8-byte aligned
+            nbytes = (nbytes + 7) // 8 * 8
+            offsets.append(nbytes)
+            nbytes += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        for (field, dtype, shape), offset in zip(self.fields, offsets):
+            setattr(
+                self,
+                field,
+                np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset),
+            )
+        if self.owner:
+            # nothing committed yet
+            self.header[:] = [-1, 0, 0]
+
+    def spec(self) -> Dict:
+        """What another process needs to attach, with SharedFrames(**spec)."""
+        return {
+            "size": self.size,
+            "width": self.width,
+            "height": self.height,
+            "parameter_count": self.parameter_count,
+            "name": self.shm.name,
+        }
+
+    def write_frame(self, slot: int, bot) -> None:
+        engine = bot.engine
+        row = bot.id
+        self.grids[slot, row] = [
+            [CELL_CODES[cell] for cell in line] for line in engine.grid
+        ]
+        self.scores[slot, row] = engine.total_score
+        self.game_over[slot, row] = engine.is_game_over
+        self.fitness[slot, row] = bot.fitness
+
+    def commit(self, event_number: int, loop_count: int, event_count: int) -> None:
+        """Make the slot of this event the one readers see."""
+        self.header[:] = [event_number, loop_count, event_count]
+
+    def read_frames(self) -> Dict:
+        """The last committed event, in the format the frontend renders.
+
+        Doesn't take a lock: the slot is copied, then the copy is thrown away
+        if the writers may have got round the ring to it in the meantime.
+        """
+        while True:
+            event_number, loop_count, event_count = self.header.tolist()
+            if event_number < 0:
+                return {}
+            slot = event_number % RING_SIZE
+            grids = self.grids[slot].tolist()
+            scores = self.scores[slot].tolist()
+            game_over = self.game_over[slot].tolist()
+            fitness = self.fitness[slot].tolist()
+            # the writers are always one slot ahead of the committed one
+            if int(self.header[0]) < event_number + RING_SIZE - 1:
+                break
+
+        bots: List[Dict] = [
+            {
+                "id": row,
+                "width": self.width,
+                "height": self.height,
+                "engine": {
+                    "score": scores[row],
+                    "isGameOver": game_over[row],
+                    "grid": [[CELL_VALUES[code] for code in line] for line in grid],
+                },
+                "fitness": fitness[row],
+                "debug": "",
+            }
+            for row, grid in enumerate(grids)
+        ]
+        return {
+            "bots": bots,
+            "version": event_number,
+            "event_count": event_count,
+            "loop_count": loop_count,
+        }
+
+    def close(self) -> None:
+        # the arrays have to go before the memory they point into
+        for field, _dtype, _shape in self.fields:
+            setattr(self, field, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
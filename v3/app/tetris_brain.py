@@ -17,6 +17,16 @@ class TetrisBrain(nn.Module):
         x = self.softmax(x)
         return x
 
+    def to_vector(self) -> torch.Tensor:
+        """All the weights and biases as one flat vector."""
+        return nn.utils.parameters_to_vector(self.parameters()).detach()
+
+    @classmethod
+    def from_vector(cls, width: int, height: int, vector) -> "TetrisBrain":
+        brain = cls(width, height)
+        nn.utils.vector_to_parameters(torch.as_tensor(vector), brain.parameters())
+        return brain
+
 
 def crossover(parent_a, parent_b):
     child = TetrisBrain()
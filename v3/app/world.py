@@ -1,22 +1,21 @@
-import asyncio
-import concurrent.futures
+import multiprocessing
 import os
 import random
-import sys
-import time
 import traceback
 from enum import Enum
 from itertools import chain
 from typing import Dict, List
 
+import torch
+from app.shared_frames import RING_SIZE, SharedFrames
 from app.tetris_bot import TetrisBot
+from app.tetris_brain import TetrisBrain
 
 cpu_count = os.cpu_count()
 max_workers = cpu_count - 1
 print(f"max_workers: {max_workers}", flush=True)
 log_file = "log.txt"
 log_header = "loop_count,scorer_count,fitness_mean,fitness_min,fitness_max"
-stop_event = asyncio.Event()
 
 
 class EventType(Enum):
@@ -26,33 +25,44 @@ class EventType(Enum):
 
 # Function to handle a chunk of bots' events
 def handle_bots_event(
-    bots: List[TetrisBot], event: EventType
-) -> List[tuple[Dict, bool]]:
+    bots: List[TetrisBot], event: EventType, frames: SharedFrames, slot: int
+) -> bool:
+    """Returns whether all the bots are game over."""
     do_tick = event == EventType.MEGATICK
-    results = []
+    all_game_over = True
 
     for bot in bots:
-        moved = bot.think_then_move(do_tick)
-        _bot_state = bot.get_state(debug=False)
-        bot_state = {
-            **_bot_state,
-            "engine": _bot_state["engine"].to_dict(),
-        }
-        results.append((bot_state, moved))
+        bot.think_then_move(do_tick)
+        frames.write_frame(slot, bot)
+        all_game_over = all_game_over and bot.engine.is_game_over
 
-    return results
+    return all_game_over
 
 
-def crossover_with_fittest(bot, bots, total_fitness):
-    parent_a_index = weighted_selection(bots, total_fitness)
-    parent_b_index = weighted_selection(bots, total_fitness)
+def crossover_with_fittest(bots: List[TetrisBot], frames: SharedFrames, slot: int):
+    """Crossover a process' bots with parents from the whole population.
 
-    parent_a = bots[parent_a_index]
-    parent_b = bots[parent_b_index]
+    The parents are loaded from their genomes once per generation, however
+    many children they have in this process.
+    """
+    fitness = frames.fitness[slot].tolist()
+    total_fitness = sum(fitness)
+    parents: Dict[int, TetrisBot] = {}
 
-    # Crossover the two parents to produce a new child brain
-    bot.crossover(parent_a, parent_b)
-    return parent_a_index, parent_b_index
+    def load_parent(bot_id: int) -> TetrisBot:
+        if bot_id not in parents:
+            brain = TetrisBrain.from_vector(
+                frames.width, frames.height, frames.genomes[bot_id].copy()
+            )
+            parents[bot_id] = TetrisBot(bot_id, frames.width, frames.height, brain)
+        return parents[bot_id]
+
+    for bot in bots:
+        parent_a_index = weighted_selection(fitness, total_fitness)
+        parent_b_index = weighted_selection(fitness, total_fitness)
+
+        # Crossover the two parents to produce a new child brain
+        bot.crossover(load_parent(parent_a_index), load_parent(parent_b_index))
 
 
 def chunkify(lst, n):
@@ -60,44 +70,59 @@ def chunkify(lst, n):
     return [lst[i::n] for i in range(n)]
 
 
-def process_event(
-    bot_chunks: List[List[TetrisBot]],
-    event: EventType,
-    state_queue: asyncio.Queue,
-    executor: concurrent.futures.Executor,
-):
-    updated_bot_states = []
-
-    # Dispatch the event to each chunk of bots concurrently
-    futures = [executor.submit(handle_bots_event, chunk, event) for chunk in bot_chunks]
-
-    # Gather all results and aggregate
-    for future in concurrent.futures.as_completed(futures):
-        try:
-            bot_results = future.result()
-            updated_bot_states.extend([bot_state for bot_state, _ in bot_results])
-        except Exception as e:
-            print(f"Exception: {e}", flush=True)
-            print(traceback.format_exc(), flush=True)
-            sys.exit(1)
-
-    # Put the updated states in the queue for the main loop to consume
-    asyncio.run_coroutine_threadsafe(
-        state_queue.put(updated_bot_states), asyncio.get_running_loop()
-    )
+def bot_process(bot_ids: List[int], bot_opts: dict, spec: dict, connection):
+    """Owns a chunk of bots, and runs the commands the simulation sends."""
+    torch.set_num_threads(1)
+    frames = SharedFrames(**spec)
+    bots = [TetrisBot(bot_id, **bot_opts) for bot_id in bot_ids]
+    for bot in bots:
+        frames.genomes[bot.id] = bot.brain.to_vector().numpy()
+
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+        name, slot = command[0], command[1]
+
+        if name == "crossover":
+            crossover_with_fittest(bots, frames, slot)
+            connection.send(True)
+        elif name == "reinit":
+            # every process has its parents, so the genomes can be overwritten
+            for bot in bots:
+                bot.reinit()
+                frames.genomes[bot.id] = bot.brain.to_vector().numpy()
+            connection.send(True)
+        else:
+            connection.send(handle_bots_event(bots, EventType(name), frames, slot))
+
+    frames.close()
+
+
+def send_to_all(connections: list, command: tuple) -> list:
+    """Send a command to every bot process, and wait for all their replies."""
+    for connection in connections:
+        connection.send(command)
+    try:
+        return [connection.recv() for connection in connections]
+    except EOFError:
+        print(traceback.format_exc(), flush=True)
+        raise Exception("A bot process died")
 
 
 def when_all_game_over(
-    bots: List[TetrisBot],
-    executor: concurrent.futures.Executor,
+    frames: SharedFrames,
+    connections: list,
+    slot: int,
     loop_count: int = 0,
 ):
-    total_fitness = sum(bot.fitness for bot in bots)
-    mean_fitness = total_fitness / len(bots)
-    min_fitness = min(bot.fitness for bot in bots)
-    max_fitness = max(bot.fitness for bot in bots)
+    fitness = frames.fitness[slot]
+    total_fitness = fitness.sum()
+    mean_fitness = total_fitness / len(fitness)
+    min_fitness = fitness.min()
+    max_fitness = fitness.max()
     # number of bots with score > 0
-    scorer_count = sum(1 for bot in bots if bot.engine.total_score > 0)
+    scorer_count = int((frames.scores[slot] > 0).sum())
 
     log = f"{loop_count},{scorer_count},{mean_fitness:.2f},{min_fitness:.2f},{max_fitness:.2f}"
     print(
@@ -107,28 +132,16 @@ def when_all_game_over(
     with open(log_file, "a") as file:
         file.write(log + "\n")
 
-    futures = [
-        executor.submit(crossover_with_fittest, bot, bots, total_fitness)
-        for bot in bots
-    ]
+    send_to_all(connections, ("crossover", slot))
+    send_to_all(connections, ("reinit", slot))
 
-    try:
-        concurrent.futures.wait(futures)
-    except Exception as e:
-        print(f"Crossover Exception: {e}", flush=True)
-        print(traceback.format_exc(), flush=True)
-        sys.exit(1)
 
-    for bot in bots:
-        bot.reinit()
-
-
-def weighted_selection(bots, total_fitness):
+def weighted_selection(fitness: List[int], total_fitness: int) -> int:
     index = 0
     start = random.uniform(0, 1)  # Random start point between 0 and 1
 
     while start > 0:
-        normalised_fitness = bots[index].fitness / total_fitness
+        normalised_fitness = fitness[index] / total_fitness
         start -= normalised_fitness
         index += 1
 
@@ -137,25 +150,44 @@ def weighted_selection(bots, total_fitness):
     return index
 
 
-async def run_bots_continuous(n: int, latest_states: Dict, bot_opts: dict = None):
-    stop_event.clear()
+def create_frames(n: int, bot_opts: dict) -> SharedFrames:
+    """The shared memory block a simulation of n bots writes its frames to."""
+    width = bot_opts.get("width", 10)
+    height = bot_opts.get("height", 20)
+    parameter_count = len(TetrisBrain(width, height).to_vector())
+    return SharedFrames(n, width, height, parameter_count)
+
 
-    if bot_opts is None:
-        bot_opts = {}
+def run_bots_continuous(n: int, bot_opts: dict, spec: dict, stop_event):
+    """Run the simulation until stop_event is set.
 
-    bots = [TetrisBot(i, **bot_opts) for i in range(n)]
-    global max_workers
-    if len(bots) < max_workers:
-        max_workers = len(bots)
-    # Split the bots into chunks
-    bot_chunks = chunkify(bots, max_workers)
+    Runs in its own process (see app/server.py), and commits every event's
+    frames to the SharedFrames block described by spec.
+    """
+    frames = SharedFrames(**spec)
+
+    # Split the bots into chunks, one per process
+    processes = max(1, min(max_workers, n))
+    bot_chunks = chunkify(list(range(n)), processes)
     for i, chunk in enumerate(bot_chunks):
         print(f"Chunk {i}: {len(chunk)} bots", flush=True)
 
-    # Create a queue to safely update latest_states
-    state_queue = asyncio.Queue()
+    context = multiprocessing.get_context("spawn")
+    connections = []
+    workers = []
+    for chunk in bot_chunks:
+        connection, child_connection = context.Pipe()
+        worker = context.Process(
+            target=bot_process,
+            args=(chunk, bot_opts, spec, child_connection),
+            daemon=True,
+        )
+        worker.start()
+        connections.append(connection)
+        workers.append(worker)
 
     loop_count = 0
+    event_number = 0
     # 8 "tick" events followed by 1 "megatick"
     events = list(chain.from_iterable([[EventType.TICK] * 8, [EventType.MEGATICK] * 1]))
 
@@ -164,8 +196,7 @@ async def run_bots_continuous(n: int, latest_states: Dict, bot_opts: dict = None
         print("Clearing log file", flush=True)
         file.write(log_header + "\n")
 
-    # Create the thread pool once
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    try:
         print("Simulation started", flush=True)
         while not stop_event.is_set():
             loop_count += 1
@@ -173,34 +204,23 @@ async def run_bots_continuous(n: int, latest_states: Dict, bot_opts: dict = None
             event_count = 0
             for event in events:
                 event_count += 1
+                event_number += 1
 
-                start = time.time()
-                process_event(bot_chunks, event, state_queue, executor)
-                end_process_event = time.time()
-
-                # Get updated states from the queue and update latest_states
-                updated_bot_states = await state_queue.get()
-                end_get_updated_states = time.time()
-
-                # print(
-                #     f"Process Event: {end_process_event - start:.5f}, Get Updated States: {end_get_updated_states - end_process_event:.5f}",
-                #     flush=True,
-                # )
-                latest_states["bots"] = updated_bot_states
-                latest_states["event_count"] = event_count
-                latest_states["loop_count"] = loop_count
-
-                # check if all bots are game over
-                all_game_over = all(bot.engine.is_game_over for bot in bots)
+                slot = event_number % RING_SIZE
+                all_game_over = all(send_to_all(connections, (event.value, slot)))
+                frames.commit(event_number, loop_count, event_count)
 
                 if all_game_over:
-                    when_all_game_over(bots, executor, loop_count)
+                    when_all_game_over(frames, connections, slot, loop_count)
                     break
 
             # Control the simulation speed (for example, 60 ticks per second)
-            # await asyncio.sleep(1 / 60)
+            # time.sleep(1 / 60)
+    finally:
+        for connection, worker in zip(connections, workers):
+            if worker.is_alive():
+                connection.send(None)
+        for worker in workers:
+            worker.join(timeout=1)
+        frames.close()
         print("Simulation stopped", flush=True)
-
-
-async def stop_bots():
-    stop_event.set()
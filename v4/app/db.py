@@ -2,6 +2,7 @@ import pickle
 
 import redis
 from app.tetris_bot import TetrisBot
+from app.tetris_brain import TetrisBrain
 
 # maybe? https://redis.io/docs/latest/develop/connect/clients/python/redis-py/#example-indexing-and-querying-json-documents
 
@@ -77,3 +78,27 @@ def db_load_all_dicts_by_key(r: redis.Redis, key: str = "bot") -> list[dict]:
         pickle.loads(bot_data) for bot_data in serialized_bots if bot_data is not None
     ]
     return bots
+
+
+def db_save_genomes(r: redis.Redis, generation: int, brains: dict[int, TetrisBrain]):
+    """Save a generation's brains to the genome store, by bot id.
+
+    Celery tasks only carry bot ids and the generation, and read and write the
+    genomes here themselves.
+    """
+    mapping = {bot_id: brain.to_bytes() for bot_id, brain in brains.items()}
+    return r.hset(f"genomes:{generation}", mapping=mapping)
+
+
+def db_load_genomes(
+    r: redis.Redis, generation: int, bot_ids: list[int], width: int, height: int
+) -> list[TetrisBrain]:
+    genomes = r.hmget(f"genomes:{generation}", bot_ids)
+    missing = [bot_id for bot_id, genome in zip(bot_ids, genomes) if genome is None]
+    if missing:
+        raise Exception(f"No genomes for bots {missing} in generation {generation}")
+    return [TetrisBrain.from_bytes(width, height, genome) for genome in genomes]
+
+
+def db_delete_genomes(r: redis.Redis, generation: int):
+    return r.delete(f"genomes:{generation}")
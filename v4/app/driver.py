@@ -1,38 +1,98 @@
-import multiprocessing
+import math
+import time
 
-from app.tetris_bot import TetrisBot
-from app.worker import bots_next_round, bots_think_then_move
+import redis
+from app.worker import bots_next_round, bots_think_then_move, celery
+from app.worker_util import CHUNK_STATS_KEY
 from celery import chord
 from celery.result import AsyncResult
 
-num_cores = multiprocessing.cpu_count() - 2
+# No chunk is so small that its overhead is more than this much of its work.
+MAX_OVERHEAD_FRACTION = 0.1
+# A task's round trip through the broker and the result backend, which the
+# workers can't measure, on top of the setup they do measure.
+TASK_OVERHEAD_SECONDS = 0.02
+# How long the number of worker processes is trusted, as inspecting is slow.
+WORKER_PROCESSES_TTL = 30
 
+worker_processes = 1
+worker_processes_checked_at = 0.0
 
-def chunkify(lst, n):
-    """Splits list into n chunks."""
-    return [lst[i::n] for i in range(n)]
 
+def count_worker_processes() -> int:
+    """The number of Celery worker processes that are up, across the cluster."""
+    global worker_processes, worker_processes_checked_at
+    if time.time() - worker_processes_checked_at < WORKER_PROCESSES_TTL:
+        return worker_processes
 
-def main(bots: list[TetrisBot] | list[dict]) -> AsyncResult:
-    """Hand bots off to Celery workers.
+    stats = celery.control.inspect(timeout=1.0).stats()
+    if stats:
+        worker_processes = sum(
+            len(worker_stats["pool"].get("processes", []))
+            or worker_stats["pool"].get("max-concurrency", 1)
+            for worker_stats in stats.values()
+        )
+    # otherwise keep the last count, as the workers may just be busy
+    worker_processes_checked_at = time.time()
+    return worker_processes
+
+
+def chunk_sizes(
+    n: int, processes: int, seconds_per_bot: float, setup_seconds: float
+) -> list[int]:
+    """Split n bots into chunks, largest first.
 
-    If this is first round, bots should be a list of TetrisBot objects, as
-    they would have been initialised in the server.
-    If this is the second+ round, bots should be a list of dicts, as they
-    would have been read from Redis.
+    Every chunk is half of what's left per process, so the first chunks keep
+    every process busy, and the small tail chunks even out the finish, as
+    whichever processes are free pick them up last. The chunks never get so
+    small that a task's setup costs more than MAX_OVERHEAD_FRACTION of its
+    bots' evaluation. Before the first generation has been measured, there are
+    at most about 4 chunks per process.
     """
+    if seconds_per_bot > 0:
+        overhead_seconds = setup_seconds + TASK_OVERHEAD_SECONDS
+        min_size = math.ceil(
+            overhead_seconds / (seconds_per_bot * MAX_OVERHEAD_FRACTION)
+        )
+    else:
+        min_size = math.ceil(n / (4 * processes))
 
-    # Check if the list contains TetrisBot objects
-    # if all(isinstance(bot, TetrisBot) for bot in bots):
-    if isinstance(bots[0], TetrisBot):
-        bots = [bot.to_dict(lite=False) for bot in bots]
+    sizes = []
+    remaining = n
+    while remaining > 0:
+        size = min(remaining, max(min_size, math.ceil(remaining / (2 * processes))))
+        sizes.append(size)
+        remaining -= size
+    return sizes
 
-    # print(f">>> bot type: {type(bots[0])}, bot: {bots[0]}")
 
-    return chord(
-        (
-            bots_think_then_move.s(bots_slice)
-            for bots_slice in chunkify(bots, num_cores)
-            if len(bots_slice) > 0
-        )
-    )(bots_next_round.s())
+def main(r: redis.Redis, generation: int, n: int) -> AsyncResult:
+    """Hand a generation of n bots off to Celery workers.
+
+    The tasks only carry the bot ids and the generation, as the bots' genomes
+    are in the genome store (see db_save_genomes), and only their fitness
+    comes back.
+
+    The chunks are sized every generation, from the cost of the last one's
+    chunks and the number of worker processes (see chunk_sizes).
+    """
+    stats = r.hgetall(CHUNK_STATS_KEY)
+    sizes = chunk_sizes(
+        n,
+        count_worker_processes(),
+        float(stats.get(b"seconds_per_bot", 0)),
+        float(stats.get(b"setup_seconds", 0)),
+    )
+    print(f"Generation {generation}: chunks of {sizes}", flush=True)
+
+    # dispatched in order, so the small chunks are queued last
+    bot_ids = list(range(n))
+    chunks = []
+    start = 0
+    for size in sizes:
+        chunks.append(bot_ids[start : start + size])
+        start += size
+
+    return chord(bots_think_then_move.s(generation, chunk) for chunk in chunks)(
+        bots_next_round.s(generation)
+    )
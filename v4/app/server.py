@@ -1,10 +1,13 @@
+import asyncio
 import time
 from contextlib import asynccontextmanager
 
 import redis
 from app import driver
-from app.db_without_pipelines import db_load_all_dicts, db_load_all_dicts_by_key
+from app.db import db_save_genomes
+from app.db_without_pipelines import db_load_all_dicts_by_key
 from app.tetris_bot import TetrisBot
+from app.worker_util import BOT_OPTS
 from celery.result import AsyncResult
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse, JSONResponse
@@ -13,6 +16,8 @@ from starlette.responses import Response
 from starlette.types import Scope
 
 result = None
+# the generation that was last dispatched, None until a run starts
+generation: int | None = None
 r: redis.Redis = None
 
 
@@ -69,25 +74,42 @@ def get_status(task_id):
 
 
 @app.get("/start")
-async def start(n: int = 10, f: str = ""):
-    global result
-
-    if result is None:
-
-        bot_opts = {"width": 10, "height": 10}
-        bots = [TetrisBot(bot_id, **bot_opts) for bot_id in range(n)]
-        result = driver.main(bots)
+async def start(n: int = 10, f: str = "", g: int | None = None):
+    """Start a run, or the next generation of the run, when a worker asks.
+
+    The frontend calls it without g every time the page loads, which only
+    starts a run if none is running. A generation is only ever dispatched
+    once, as its genomes are deleted when the next generation is bred.
+    """
+    global result, generation
+
+    if g is None:
+        if generation is not None:
+            return {"message": f"Already running generation {generation}"}
+
+        # set before awaiting, so a request in the meantime doesn't start another
+        generation = 0
+        bots = [TetrisBot(bot_id, **BOT_OPTS) for bot_id in range(n)]
+        await asyncio.to_thread(
+            db_save_genomes, r, 0, {bot.id: bot.brain for bot in bots}
+        )
+        result = await asyncio.to_thread(driver.main, r, 0, n)
 
         return {"message": f"Started {n} bots"}
-    else:
 
-        start_time = time.time()
-        bots = db_load_all_dicts(r, range(n))
-        result = driver.main(bots)
-        end_time = time.time()
-        print(f"New round prep {end_time - start_time:.2f} seconds")
+    if generation is not None and g <= generation:
+        return {"message": f"Generation {g} was already started"}
+
+    # the workers have already saved generation g's genomes
+    start_time = time.time()
+    generation = g
+    # the driver asks the Celery workers how many processes they have, which
+    # blocks for up to a second, so it mustn't run on the event loop
+    result = await asyncio.to_thread(driver.main, r, g, n)
+    end_time = time.time()
+    print(f"New round prep {end_time - start_time:.2f} seconds")
 
-        return {"message": f"Next round for {n} bots"}
+    return {"message": f"Next round for {n} bots, generation {g}"}
 
 
 @app.get("/ping")
@@ -26,6 +26,18 @@ class TetrisBrain(nn.Module):
         brain.load_state_dict(data)
         return brain
 
+    def to_bytes(self) -> bytes:
+        """All the weights and biases as one flat float32 buffer."""
+        vector = nn.utils.parameters_to_vector(self.parameters()).detach()
+        return vector.numpy().tobytes()
+
+    @classmethod
+    def from_bytes(cls, width, height, data: bytes):
+        brain = cls(width, height)
+        vector = torch.frombuffer(bytearray(data), dtype=torch.float32)
+        nn.utils.vector_to_parameters(vector, brain.parameters())
+        return brain
+
 
 def crossover(parent_a, parent_b):
     child = TetrisBrain()
@@ -5,11 +5,12 @@ import urllib.request
 from enum import Enum
 
 import redis
+from app.db import db_delete_genomes, db_load_genomes, db_save_genomes
 from app.db_without_pipelines import db_save_all_dict
 from app.tetris_bot import TetrisBot
-from app.tetris_engine import TetrisEngine
-from app.worker_util import crossover_with_fittest
-from celery import Celery
+from app.tetris_brain import crossover, mutate
+from app.worker_util import BOT_OPTS, CHUNK_STATS_KEY, selection_plan
+from celery import Celery, chord
 
 celery = Celery(__name__)
 celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
@@ -36,76 +37,97 @@ events = [EventType.TICK] * 8 + [EventType.MEGATICK] * 1
 
 
 @celery.task(name="bots_next_round", bind=True)
-def bots_next_round(self, results):
+def bots_next_round(self, results, generation: int):
+    """Plan the next generation, and fan the crossover out over the workers.
 
+    Only the parents of every child are chosen here, from the fitness. The
+    crossover and mutation are done by a bots_crossover task per chunk, which
+    write the children to the genome store, and bots_start_next_round starts
+    the next generation once they're all done.
+    """
     start_time = time.time()
 
-    bot_dicts = [bot for results_chunk in results for bot in results_chunk["bots_dict"]]
-
-    # crossover and mutation, re-init, before saving to Redis
-    bots = [TetrisBot.from_dict(bot) for bot in bot_dicts]
-
-    time_deser_bots = time.time()
+    chunks = [results_chunk["bot_ids"] for results_chunk in results]
+    bot_ids = [bot_id for chunk in chunks for bot_id in chunk]
+    fitness = [
+        bot_fitness
+        for results_chunk in results
+        for bot_fitness in results_chunk["fitness"]
+    ]
+
+    # for the next generation's chunk sizes, see driver.chunk_sizes
+    r.hset(
+        CHUNK_STATS_KEY,
+        mapping={
+            "seconds_per_bot": sum(chunk["seconds"] for chunk in results)
+            / len(bot_ids),
+            "setup_seconds": sum(chunk["setup_seconds"] for chunk in results)
+            / len(results),
+        },
+    )
 
-    total_fitness = sum(bot.fitness for bot in bots)
-    # mean_fitness = total_fitness / len(bots)
-    # min_fitness = min(bot.fitness for bot in bots)
-    # max_fitness = max(bot.fitness for bot in bots)
-    # # number of bots with score > 0
-    # scorer_count = sum(1 for bot in bots if bot.engine.total_score > 0)
+    # by child id
+    plan = {parents[0]: parents for parents in selection_plan(bot_ids, fitness)}
+    chord(
+        bots_crossover.s(generation, [plan[bot_id] for bot_id in chunk])
+        for chunk in chunks
+    )(bots_start_next_round.s(generation, len(bot_ids)))
 
-    # log = f"{scorer_count},{mean_fitness:.2f},{min_fitness:.2f},{max_fitness:.2f}"
-    # print(
-    #     log,
-    #     flush=True,
-    # )
+    print(f">timings: plan_time={time.time() - start_time:.2f}", flush=True)
 
-    for bot in bots:
-        crossover_with_fittest(bot, bots, total_fitness)
+    return {"generation": generation, "bot_ids": bot_ids, "fitness": fitness}
 
-    time_crossover = time.time()
-    for bot in bots:
-        bot.reinit()
-    time_reinit = time.time()
 
-    bot_dicts = [bot.to_dict(lite=False) for bot in bots]
+@celery.task(name="bots_crossover")
+def bots_crossover(generation: int, plan: list[tuple[int, int, int]]):
+    """Crossover and mutate a chunk of children, see selection_plan."""
+    parent_ids = sorted({parent_id for _, a, b in plan for parent_id in (a, b)})
+    parents = dict(
+        zip(parent_ids, db_load_genomes(r, generation, parent_ids, **BOT_OPTS))
+    )
 
-    time_serialize = time.time()
+    children = {}
+    for child_id, parent_a_id, parent_b_id in plan:
+        child_brain = crossover(parents[parent_a_id], parents[parent_b_id])
+        mutate(child_brain, mutation_rate=0.01)
+        children[child_id] = child_brain
 
-    # bot_id_0 = [bot for bot in bot_dicts if bot["id"] == 0]
-    # print(
-    #     f">bots_next_round: {bot_id_0}",
-    #     flush=True,
-    # )
+    db_save_genomes(r, generation + 1, children)
+    return len(children)
 
-    db_result = db_save_all_dict(r, bot_dicts)
-    if not db_result:
-        raise Exception("Failed to save bots to Redis")
 
-    time_persist = time.time()
-    print(
-        f">timings: total_time={time_persist - start_time:.2f}, time_deser_bots={time_deser_bots-start_time:.2f}, time_crossover={time_crossover-time_deser_bots:.2f}, time_reinit={time_reinit-time_crossover:.2f}, time_serialize={time_serialize-time_reinit:.2f}, time_persist={time_persist-time_serialize:.2f}",
-        flush=True,
-    )
+@celery.task(name="bots_start_next_round", bind=True)
+def bots_start_next_round(self, results, generation: int, n: int):
+    # every child of the next generation has been saved
+    db_delete_genomes(r, generation)
 
     print(f"worker pinging server to start next round", flush=True)
     urllib.request.urlopen(
-        f"http://web:8000/start?n={len(bot_dicts)}&f={self.request.id}"
+        f"http://web:8000/start?n={n}&g={generation + 1}&f={self.request.id}"
     ).read()
 
-    # TODO change this to the newly-initialised bots
-    return results
+    return {"generation": generation + 1, "children": sum(results)}
 
 
 @celery.task(name="bots_think_then_move", bind=True)
-def bots_think_then_move(self, bots: list[TetrisBot]):
-    if len(bots) == 0:
+def bots_think_then_move(self, generation: int, bot_ids: list[int]):
+    if len(bot_ids) == 0:
         return "no_bots"
-    # deserialize bots
-    bots = [TetrisBot.from_dict(bot) for bot in bots]
+    start_time = time.time()
+    # the task only carries the ids, the brains are in the genome store
+    brains = db_load_genomes(r, generation, bot_ids, **BOT_OPTS)
+    bots = [
+        TetrisBot(bot_id, **BOT_OPTS, brain=brain)
+        for bot_id, brain in zip(bot_ids, brains)
+    ]
+    setup_seconds = time.time() - start_time
 
     try:
-        return _bots_think_then_move(self, bots)
+        result = _bots_think_then_move(self, bots)
+        # measured for the driver's chunk sizing
+        result["setup_seconds"] = setup_seconds
+        result["seconds"] = time.time() - start_time - setup_seconds
+        return result
     except Exception as e:
         task_id = self.request.id
         print(f"Exception: task={task_id}, exception={e}", flush=True)
@@ -116,11 +138,6 @@ def bots_think_then_move(self, bots: list[TetrisBot]):
 
 def _bots_think_then_move(self, bots: list[TetrisBot]):
 
-    # even though TetrisEngine has to_dict/from_dict, it's only used for rendering, and
-    # we know we'll always need a fresh engine at this point
-    for bot in bots:
-        bot.engine = TetrisEngine(bot.width, bot.height)
-
     loop_count = 0
     while True:
         loop_count += 1
@@ -153,12 +170,14 @@ def _bots_think_then_move(self, bots: list[TetrisBot]):
                 if bot_id_0:
                     print(f">all_game_over: {bot_id_0}", flush=True)
 
+                # only the fitness goes back through the result backend
                 return {
                     "count": {
                         "loop": loop_count,
                         "event": event_count,
                     },
-                    "bots_dict": [bot.to_dict(lite=False) for bot in bots],
+                    "bot_ids": [bot.id for bot in bots],
+                    "fitness": [bot.fitness for bot in bots],
                 }
 
 
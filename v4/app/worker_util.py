@@ -1,23 +1,29 @@
 import random
 
-from app.tetris_bot import TetrisBot
+# The size of every bot's grid, for the server and the workers.
+BOT_OPTS = {"width": 10, "height": 10}
+# The cost of the last generation's chunks, written by the workers for the driver.
+CHUNK_STATS_KEY = "chunk_stats"
 
 
-def crossover_with_fittest(
-    bot: TetrisBot, bots: list[TetrisBot], total_fitness: float
-) -> tuple[int, int]:
-    parent_a_index = weighted_selection(bots, total_fitness)
-    parent_b_index = weighted_selection(bots, total_fitness)
+def selection_plan(
+    bot_ids: list[int], fitness: list[float]
+) -> list[tuple[int, int, int]]:
+    """Choose both parents of every bot's child.
 
-    parent_a = bots[parent_a_index]
-    parent_b = bots[parent_b_index]
-
-    # Crossover the two parents to produce a new child brain
-    bot.crossover(parent_a, parent_b)
-    return parent_a_index, parent_b_index
+    Returns:
+        list[tuple[int, int, int]]: (child id, parent a id, parent b id)
+    """
+    total_fitness = sum(fitness)
+    plan = []
+    for bot_id in bot_ids:
+        parent_a_index = weighted_selection(fitness, total_fitness)
+        parent_b_index = weighted_selection(fitness, total_fitness)
+        plan.append((bot_id, bot_ids[parent_a_index], bot_ids[parent_b_index]))
+    return plan
 
 
-def weighted_selection(bots: list[TetrisBot], total_fitness: float) -> int:
+def weighted_selection(fitness: list[float], total_fitness: float) -> int:
     """Select a fit bot.
 
     This function uses a relay-race technique for giving a fair shot to
@@ -25,7 +31,7 @@ def weighted_selection(bots: list[TetrisBot], total_fitness: float) -> int:
     selection for those with higher fitness scores.
 
     Args:
-        bots (list[TetrisBot]): the bot population
+        fitness (list[float]): the fitness of every bot in the population
         total_fitness (float): the total fitness of the population
 
     Returns:
@@ -35,7 +41,7 @@ def weighted_selection(bots: list[TetrisBot], total_fitness: float) -> int:
     start = random.uniform(0, 1)
 
     while start > 0:
-        normalised_fitness = bots[index].fitness / total_fitness
+        normalised_fitness = fitness[index] / total_fitness
         start -= normalised_fitness
         index += 1
 
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+
+import numpy as np
+import redis
+from app.db import db_load_all_dicts
+from app.tetris_brain import state_dict_to_vector
+from dotenv import load_dotenv
+
+load_dotenv()
+# Archive the ARCHIVE_TOP_K fittest genomes of every generation, 0 means never.
+ARCHIVE_TOP_K = int(os.getenv("ARCHIVE_TOP_K", 0))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "checkpoints/hall_of_fame.bin")
+
+# The archive is a fixed-size header, followed by one fixed-size record per
+# generation, so any generation can be found by its offset:
+# - header: b"HOF1", then the JSON dimensions, padded with spaces to HEADER_SIZE
+# - record: see record_dtype
+HEADER_SIZE = 4096
+MAGIC = b"HOF1"
+
+
+def record_dtype(population_size: int, top_k: int, parameter_count: int):
+    return np.dtype(
+        [
+            ("generation", "<i8"),
+            ("best_ids", "<i4", (top_k,)),
+            ("best_fitness", "<f4", (top_k,)),
+            ("genomes", "<f4", (top_k, parameter_count)),
+            ("fitness", "<f4", (population_size,)),
+        ]
+    )
+
+
+def read_header(path: str) -> dict:
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+        raise ValueError(f"Not a hall of fame archive: {path}")
+    return json.loads(header[len(MAGIC) :].decode("utf-8"))
+
+
+def write_header(path: str, dimensions: dict):
+    header = MAGIC + json.dumps(dimensions).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(header.ljust(HEADER_SIZE, b" "))
+
+
+def archive_generation(
+    r: redis.Redis,
+    generation: int,
+    all_fitness: list[float | None],
+    path: str = ARCHIVE_PATH,
+    top_k: int = ARCHIVE_TOP_K,
+):
+    """Append the fittest genomes and all fitness values of a generation.
+
+    Like save_checkpoint, it reads the genomes from Redis, so it must be called
+    after all workers have saved their bots. Bots without fitness are stored
+    as NaN.
+    """
+    fitness = np.array(
+        [np.nan if value is None else value for value in all_fitness],
+        dtype=np.float32,
+    )
+    best_ids = np.argsort(np.nan_to_num(fitness, nan=-np.inf))[::-1][:top_k]
+    best_dicts = {
+        bot_dict["id"]: bot_dict
+        for bot_dict in db_load_all_dicts(r, [int(bot_id) for bot_id in best_ids])
+    }
+    genomes = [state_dict_to_vector(best_dicts[bot_id]["brain"]) for bot_id in best_ids]
+
+    dimensions = {
+        "population_size": len(fitness),
+        "top_k": len(best_ids),
+        "parameter_count": len(genomes[0]),
+        "width": best_dicts[best_ids[0]]["width"],
+        "height": best_dicts[best_ids[0]]["height"],
+    }
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write_header(path, dimensions)
+    elif read_header(path) != dimensions:
+        raise ValueError(f"Archive {path} has different dimensions: {dimensions}")
+
+    record = np.zeros(
+        1,
+        dtype=record_dtype(
+            dimensions["population_size"],
+            dimensions["top_k"],
+            dimensions["parameter_count"],
+        ),
+    )
+    record["generation"] = generation
+    record["best_ids"] = best_ids
+    record["best_fitness"] = fitness[best_ids]
+    record["genomes"] = np.stack([genome.numpy() for genome in genomes])
+    record["fitness"] = fitness
+
+    with open(path, "r+b") as f:
+        # drop a record that was only partly written (e.g. the worker died),
+        # so the new one starts where a record should
+        record_count = (os.path.getsize(path) - HEADER_SIZE) // record.itemsize
+        f.truncate(HEADER_SIZE + record_count * record.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(record.tobytes())
+
+
+def open_archive(path: str = ARCHIVE_PATH) -> np.memmap:
+    """Memory-map the archive as an array of records, one per generation.
+
+    Nothing is read until it's used, e.g. archive[-1]["genomes"][0] is the
+    fittest genome of the last generation, and archive["fitness"][:, 42]
+    is bot 42's fitness over all generations. A record that was only partly
+    written (e.g. the worker died) is left out, and overwritten by the next
+    archive_generation.
+    """
+    dimensions = read_header(path)
+    dtype = record_dtype(
+        dimensions["population_size"],
+        dimensions["top_k"],
+        dimensions["parameter_count"],
+    )
+    record_count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    return np.memmap(
+        path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(record_count,)
+    )
+
+
+if __name__ == "__main__":
+    archive = open_archive(sys.argv[1] if len(sys.argv) > 1 else ARCHIVE_PATH)
+    print(f"generations: {len(archive)}")
+    if len(archive):
+        last = archive[-1]
+        print(f"last generation: {last['generation']}")
+        print(f"best fitness: {last['best_fitness'].tolist()}")
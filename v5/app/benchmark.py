@@ -0,0 +1,221 @@
+"""Benchmark the generational pipeline end to end, without Docker.
+
+Runs K workers as local processes, against a local redis-server if there is
+one on the PATH, or an in-process fakeredis server otherwise, for a fixed
+number of seeded generations, and reports generations/sec, bot moves/sec,
+bytes through Redis and where the time went:
+
+    python -m app.benchmark --workers 4 --bots-per-worker 10 --generations 5
+
+Nothing here is imported by the workers, and the app modules are only
+imported in the worker processes, after their environment has been set up.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import redis
+from app.metrics import read_all_metrics
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_redis(port: int):
+    """Start a local Redis stand-in. Returns a function that stops it."""
+    if shutil.which("redis-server"):
+        process = subprocess.Popen(
+            ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL,
+        )
+        stop = process.terminate
+    else:
+        # optional, only needed on machines without redis-server
+        from fakeredis import TcpFakeServer
+
+        server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stop = server.shutdown
+
+    r = redis.Redis(host="127.0.0.1", port=port)
+    for _ in range(100):
+        try:
+            r.ping()
+            return stop
+        except redis.ConnectionError:
+            time.sleep(0.05)
+    stop()
+    raise Exception(f"Redis didn't start on port {port}")
+
+
+def run_worker(index: int, env: dict[str, str], seed: int):
+    os.environ.update(env)
+    os.environ["WORKER_NAME"] = f"benchmark-{index}"
+
+    import torch
+
+    random.seed(seed + index)
+    torch.manual_seed(seed + index)
+    # one thread per worker, as each worker has a core to itself in production
+    torch.set_num_threads(1)
+
+    from app import worker
+
+    asyncio.run(worker.main())
+
+
+def sum_labelled(all_metrics: dict[str, dict], name: str) -> dict[str, float]:
+    """Sum a labelled counter over all workers, by key prefix."""
+    by_prefix: dict[str, float] = {}
+    for snapshot in all_metrics.values():
+        for label_string, value in snapshot["labelled_counters"].get(name, {}).items():
+            prefix = label_string.split('prefix="')[1].rstrip('"')
+            by_prefix[prefix] = by_prefix.get(prefix, 0) + value
+    return by_prefix
+
+
+def report(all_metrics: dict[str, dict], generations: int, seconds: float) -> dict:
+    phase_seconds: dict[str, float] = {}
+    phase_calls: dict[str, int] = {}
+    moves = 0
+    for snapshot in all_metrics.values():
+        for phase, value in snapshot["phase_seconds"].items():
+            phase_seconds[phase] = phase_seconds.get(phase, 0) + value
+        for phase, value in snapshot["phase_calls"].items():
+            phase_calls[phase] = phase_calls.get(phase, 0) + value
+        moves += snapshot["counters"].get("moves", 0)
+
+    bytes_sent = sum_labelled(all_metrics, "redis_bytes_sent")
+    bytes_received = sum_labelled(all_metrics, "redis_bytes_received")
+    commands = sum_labelled(all_metrics, "redis_commands")
+    return {
+        "workers": len(all_metrics),
+        "generations": generations,
+        "seconds": seconds,
+        "generations_per_second": generations / seconds,
+        "moves": moves,
+        "moves_per_second": moves / seconds,
+        "redis_commands": sum(commands.values()),
+        "redis_bytes_sent": sum(bytes_sent.values()),
+        "redis_bytes_received": sum(bytes_received.values()),
+        "redis_by_prefix": {
+            prefix: {
+                "commands": commands[prefix],
+                "bytes_sent": bytes_sent.get(prefix, 0),
+                "bytes_received": bytes_received.get(prefix, 0),
+            }
+            for prefix in sorted(commands)
+        },
+        # summed over workers, and nested, e.g. inference is part of evaluate
+        "phase_seconds": dict(
+            sorted(phase_seconds.items(), key=lambda item: item[1], reverse=True)
+        ),
+        "phase_calls": phase_calls,
+    }
+
+
+def print_report(result: dict):
+    print(
+        f"{result['workers']} workers, {result['generations']} generations "
+        f"in {result['seconds']:.2f}s"
+    )
+    print(f"generations/sec: {result['generations_per_second']:.3f}")
+    print(f"bot moves/sec:   {result['moves_per_second']:.1f}")
+    print(
+        f"redis: {result['redis_commands']:.0f} commands, "
+        f"{result['redis_bytes_sent'] / 1e6:.2f} MB sent, "
+        f"{result['redis_bytes_received'] / 1e6:.2f} MB received"
+    )
+    for prefix, io in result["redis_by_prefix"].items():
+        print(
+            f"  {prefix:<16} {io['commands']:>8.0f} commands "
+            f"{io['bytes_sent'] / 1e6:>8.2f} MB sent "
+            f"{io['bytes_received'] / 1e6:>8.2f} MB received"
+        )
+    print("phases (seconds per worker per generation, nested):")
+    worker_generations = result["workers"] * result["generations"]
+    for phase, seconds in result["phase_seconds"].items():
+        print(f"  {phase:<28} {seconds / worker_generations:>10.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--bots-per-worker", type=int, default=10)
+    parser.add_argument("--generations", type=int, default=3)
+    parser.add_argument("--max-ticks-per-bot", type=int, default=0)
+    parser.add_argument("--evaluation-processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    port = free_port()
+    stop_redis = start_redis(port)
+    log_dir = tempfile.mkdtemp(prefix="benchmark-")
+    env = {
+        "REDIS_HOST": "127.0.0.1",
+        "REDIS_PORT": str(port),
+        "NUMBER_OF_WORKERS": str(args.workers),
+        "BOTS_PER_WORKER": str(args.bots_per_worker),
+        "MAX_TICKS_PER_BOT": str(args.max_ticks_per_bot),
+        "MAX_GENERATIONS": str(args.generations),
+        "EVALUATION_PROCESSES": str(args.evaluation_processes),
+        "EVOLUTION_MODE": "generational",
+        "CHECKPOINT_EVERY": "0",
+        "RESUME_FROM": "",
+        "ARCHIVE_TOP_K": "0",
+        "LOG_DIR": log_dir,
+        "PROFILE_DIR": log_dir,
+        "TRACE_DIR": log_dir,
+    }
+
+    try:
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=run_worker, args=(index, env, args.seed))
+            for index in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # time from the end of the first barrier, so start-up isn't counted
+        r = redis.Redis(host="127.0.0.1", port=port)
+        while (r.zscore("ticks", "tick") or 0) < 2:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            time.sleep(0.01)
+        started_at = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - started_at
+
+        failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+        if failed:
+            raise Exception(f"{len(failed)} workers failed, see the logs in {log_dir}")
+
+        result = report(read_all_metrics(r), args.generations, seconds)
+    finally:
+        stop_redis()
+
+    print_report(result)
+    print(f"logs: {log_dir}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import json
+import os
+import pickle
+import random
+import shutil
+from dataclasses import dataclass
+
+import numpy as np
+import redis
+import torch
+from app.db import db_load_all_dicts
+from app.tetris_brain import TetrisBrain, state_dict_to_vector
+from dotenv import load_dotenv
+
+load_dotenv()
+# Write a checkpoint every CHECKPOINT_EVERY generations, 0 means never.
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", 0))
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+# A checkpoint directory to resume from, or "latest".
+RESUME_FROM = os.getenv("RESUME_FROM", "")
+
+# Layout of a checkpoint directory, e.g. checkpoints/generation-000042/:
+# - genomes.npy: float32 [population_size, parameter_count], one bot per row
+# - fitness.npy: float32 [population_size], NaN for bots that have no genome
+# - meta.json: generation, brain size, and the workers' bot id ranges
+# - rng.pkl: the workers' Python and PyTorch RNG states, by worker index
+# The .npy files can be opened with np.load(..., mmap_mode="r").
+
+
+@dataclass
+class Checkpoint:
+    path: str
+    generation: int
+    width: int
+    height: int
+    genomes: np.ndarray
+    fitness: np.ndarray
+    members: list[str]
+    rng_states: dict[int, tuple]
+
+    def brain(self, bot_id: int) -> TetrisBrain | None:
+        """The brain of a bot, or None if the bot wasn't in the checkpoint."""
+        if bot_id >= len(self.fitness) or np.isnan(self.fitness[bot_id]):
+            return None
+        return TetrisBrain.from_vector(self.width, self.height, self.genomes[bot_id])
+
+
+def save_rng_state(r: redis.Redis, name: str, generation: int):
+    """Share this worker's RNG states, so the leader can checkpoint them."""
+    key = f"rng_state:{generation}"
+    r.hset(key, name, pickle.dumps((random.getstate(), torch.get_rng_state())))
+    r.expire(key, 60 * 60)
+
+
+def restore_rng_state(checkpoint: Checkpoint, index: int):
+    """Restore the RNG states of the worker that had this index."""
+    if index not in checkpoint.rng_states:
+        return
+    python_state, torch_state = checkpoint.rng_states[index]
+    random.setstate(python_state)
+    torch.set_rng_state(torch_state)
+
+
+def save_checkpoint(
+    r: redis.Redis,
+    generation: int,
+    population_size: int,
+    all_fitness: list[float | None],
+    members: list[str],
+    assignment: dict[str, list[int]],
+) -> str:
+    """Write the whole population, as it was evaluated in this generation.
+
+    Reads every bot's brain from Redis, so it must be called after all
+    workers have saved their bots, and before the next generation overwrites
+    them. The checkpoint is written to a temporary directory which is then
+    renamed into place, so a crash never leaves a half-written checkpoint.
+
+    Returns the path of the checkpoint.
+    """
+    bot_dicts = db_load_all_dicts(r, list(range(population_size)))
+    width, height = bot_dicts[0]["width"], bot_dicts[0]["height"]
+    parameter_count = len(state_dict_to_vector(bot_dicts[0]["brain"]))
+
+    genomes = np.zeros((population_size, parameter_count), dtype=np.float32)
+    fitness = np.full(population_size, np.nan, dtype=np.float32)
+    for bot_dict in bot_dicts:
+        bot_id = bot_dict["id"]
+        if all_fitness[bot_id] is None:
+            continue
+        genomes[bot_id] = state_dict_to_vector(bot_dict["brain"]).numpy()
+        fitness[bot_id] = all_fitness[bot_id]
+
+    rng_states = {
+        members.index(name.decode("utf-8")): pickle.loads(state)
+        for name, state in r.hgetall(f"rng_state:{generation}").items()
+        if name.decode("utf-8") in members
+    }
+    meta = {
+        "generation": generation,
+        "width": width,
+        "height": height,
+        "members": members,
+        "bot_ids": [assignment.get(name, []) for name in members],
+    }
+
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = os.path.join(CHECKPOINT_DIR, f"generation-{generation:06d}")
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "genomes.npy"), genomes)
+    np.save(os.path.join(tmp_path, "fitness.npy"), fitness)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    with open(os.path.join(tmp_path, "rng.pkl"), "wb") as f:
+        pickle.dump(rng_states, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    latest_tmp_path = os.path.join(CHECKPOINT_DIR, "latest.tmp")
+    with open(latest_tmp_path, "w") as f:
+        f.write(os.path.basename(path))
+    os.replace(latest_tmp_path, os.path.join(CHECKPOINT_DIR, "latest"))
+
+    return path
+
+
+def load_checkpoint(path: str) -> Checkpoint:
+    """Open a checkpoint directory, or "latest" in CHECKPOINT_DIR.
+
+    The genomes are memory-mapped, so only the rows a worker needs are read.
+    """
+    if path == "latest":
+        with open(os.path.join(CHECKPOINT_DIR, "latest")) as f:
+            path = os.path.join(CHECKPOINT_DIR, f.read().strip())
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    with open(os.path.join(path, "rng.pkl"), "rb") as f:
+        rng_states = pickle.load(f)
+
+    return Checkpoint(
+        path=path,
+        generation=meta["generation"],
+        width=meta["width"],
+        height=meta["height"],
+        genomes=np.load(os.path.join(path, "genomes.npy"), mmap_mode="r"),
+        fitness=np.load(os.path.join(path, "fitness.npy"), mmap_mode="r"),
+        members=meta["members"],
+        rng_states=rng_states,
+    )
@@ -1,29 +1,215 @@
 import asyncio
 import functools
+import json
+import os
+import socket
+import threading
+import time
 
-import redis
 from app.fake_bot import TetrisBot
+from app.metrics import BARRIER_WAIT_BUCKETS, metrics
+from app.redis_io import redis_client
 
-r = redis.Redis(host="redis", port=6379, db=0)
+r = redis_client()
+# The container's hostname, unless several workers run on one host.
+UNIQ = os.getenv("WORKER_NAME", socket.gethostname())
+WORKER_LEASE_TTL = int(os.getenv("WORKER_LEASE_TTL", 10))
+FIRST_TICK = 2
 
 
 @functools.lru_cache(maxsize=1)
 def get_worker_index():
+    # Only used as a label (e.g. for log file names), as it's never reset.
+    # Bot ranges come from Membership instead.
     index = r.incr(f"worker_index")
     return index - 1
 
 
+class Membership:
+    """Workers that are currently taking part in the experiment.
+
+    Every worker holds a lease (`worker_lease:{name}`) which expires unless
+    it's refreshed by the heartbeat thread. The `workers` hash maps each
+    worker's name to the first tick it takes part in, so a worker that joins
+    mid-run doesn't hold up a barrier the others are already waiting on.
+    """
+
+    def __init__(self, name: str = UNIQ, ttl: int = WORKER_LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._heartbeat_thread: threading.Thread | None = None
+
+    def join(self) -> int:
+        """Take a lease and register as a member.
+
+        Returns the first tick this worker takes part in, which is always
+        the start of a generation (an even tick).
+        """
+        self.heartbeat()
+        first_tick = self.next_generation_tick()
+        r.hset("workers", self.name, first_tick)
+        self.start_heartbeat()
+        return first_tick
+
+    def next_generation_tick(self) -> int:
+        current_tick = int(r.zscore("ticks", "tick") or FIRST_TICK - 1)
+        return current_tick + 1 if current_tick % 2 else current_tick + 2
+
+    def heartbeat(self):
+        r.set(f"worker_lease:{self.name}", 1, ex=self.ttl)
+
+    def rejoin(self):
+        """Register again if live_members dropped this worker, e.g. after its
+        lease lapsed during a Redis blip, from the next generation on."""
+        if not r.hexists("workers", self.name):
+            first_tick = self.next_generation_tick()
+            if r.hsetnx("workers", self.name, first_tick):
+                metrics.inc("rejoins")
+
+    def start_heartbeat(self):
+        if self._heartbeat_thread is not None:
+            return
+
+        # A thread rather than an asyncio task, because the worker's event loop
+        # is blocked while the bots are playing.
+        def beat():
+            while True:
+                self.heartbeat()
+                self.rejoin()
+                time.sleep(self.ttl / 3)
+
+        self._heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        self._heartbeat_thread.start()
+
+    def live_members(self, tick: int | None = None) -> list[str]:
+        """Names of the workers expected at this tick (or all live ones), sorted.
+
+        Workers whose lease has expired are removed from the `workers` hash.
+        """
+        workers = {
+            name.decode("utf-8"): int(first_tick)
+            for name, first_tick in r.hgetall("workers").items()
+        }
+        names = sorted(workers)
+        with r.pipeline() as pipe:
+            for name in names:
+                pipe.exists(f"worker_lease:{name}")
+            alive = pipe.execute()
+
+        dead = [name for name, is_alive in zip(names, alive) if not is_alive]
+        if dead:
+            r.hdel("workers", *dead)
+
+        return [
+            name
+            for name, is_alive in zip(names, alive)
+            if is_alive and (tick is None or workers[name] <= tick)
+        ]
+
+
 class Coordinator:
-    def __init__(self, number_of_workers: int):
+    def __init__(self, number_of_workers: int, name: str = UNIQ):
         self.id = get_worker_index()
+        # only used to hold back the very first generation until the
+        # initial replicas have all joined
         self.number_of_workers = number_of_workers
+        self.membership = Membership(name)
+        self.name = self.membership.name
+
+    def join(self) -> int:
+        return self.membership.join()
 
     async def wait_for_all_workers(self, tick: int):
         tick_key = f"tick:{tick}"
+        started_at = time.perf_counter()
 
         # Set the tick for the current worker in a Redis hash
-        r.hset(tick_key, self.id, tick)
+        r.hset(tick_key, self.name, tick)
+        r.expire(tick_key, 60 * 60)
 
-        # Wait until the hash length is equal to the number of workers
-        while r.hlen(tick_key) < self.number_of_workers:
+        # Wait until every live member has reached this tick.
+        # Members are re-read on every poll, so a worker that dies
+        # doesn't wedge the barrier once its lease expires.
+        while True:
+            arrived = {name.decode("utf-8") for name in r.hkeys(tick_key)}
+            members = self.membership.live_members(tick)
+            starting = tick == FIRST_TICK and len(members) < self.number_of_workers
+            if not starting and set(members) <= arrived:
+                # workers that join from now on start at the next generation
+                r.zadd("ticks", {"tick": tick}, gt=True)
+                waited = time.perf_counter() - started_at
+                metrics.add_time("barrier_wait", waited)
+                metrics.observe("barrier_wait_seconds", waited, BARRIER_WAIT_BUCKETS)
+                return
             await asyncio.sleep(0.1)
+
+    def members_at(self, tick: int) -> list[str]:
+        """The members for the generation starting at this tick.
+
+        The first worker through the barrier stores its view of the members,
+        so all workers agree on it, even if a lease expires in between.
+        """
+        members_key = f"members:{tick}"
+        r.set(
+            members_key,
+            ",".join(self.membership.live_members(tick)),
+            nx=True,
+            ex=60 * 60,
+        )
+        members = r.get(members_key).decode("utf-8")
+        return members.split(",") if members else []
+
+    def assignment_at(self, tick: int, population_size: int) -> dict[str, list[int]]:
+        """The bot ids of every member for the generation starting at this tick.
+
+        Worked out from the last generation's assignment (see
+        balanced_assignment), and stored by the first worker through the
+        barrier, like members_at.
+        """
+        assignment_key = f"assignment:{tick}"
+        if not r.exists(assignment_key):
+            previous = r.get(f"assignment:{tick - 2}")
+            assignment = balanced_assignment(
+                self.members_at(tick),
+                population_size,
+                json.loads(previous) if previous else {},
+            )
+            r.set(assignment_key, json.dumps(assignment), nx=True, ex=60 * 60)
+        return json.loads(r.get(assignment_key))
+
+    def assigned_bot_ids(self, tick: int, population_size: int) -> list[int]:
+        """This worker's share of the population at this tick.
+
+        Empty if it joined too late to be part of this generation.
+        """
+        return self.assignment_at(tick, population_size).get(self.name, [])
+
+
+def balanced_assignment(
+    members: list[str], population_size: int, previous: dict[str, list[int]]
+) -> dict[str, list[int]]:
+    """Split the population evenly between the members, moving as few bot ids
+    as possible from the previous assignment.
+
+    Every member keeps as many of its previous bot ids as its share allows,
+    and only the rest are handed out, so a worker joining or leaving moves
+    about one share of the population, rather than most of it. Without a
+    previous assignment, the members get contiguous ranges.
+    """
+    shares = [
+        (index + 1) * population_size // len(members)
+        - index * population_size // len(members)
+        for index in range(len(members))
+    ]
+    assignment = {}
+    for name, share in zip(members, shares):
+        kept = [bot_id for bot_id in previous.get(name, []) if bot_id < population_size]
+        assignment[name] = sorted(kept)[:share]
+
+    taken = {bot_id for bot_ids in assignment.values() for bot_id in bot_ids}
+    free = [bot_id for bot_id in range(population_size) if bot_id not in taken]
+    for name, share in zip(members, shares):
+        missing = share - len(assignment[name])
+        assignment[name] = sorted(assignment[name] + free[:missing])
+        free = free[missing:]
+    return assignment
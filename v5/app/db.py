@@ -1,11 +1,15 @@
 import pickle
+import time
 
 import redis
+import redis.asyncio
+from app.metrics import metrics
 from app.tetris_bot import TetrisBot
 
 # maybe? https://redis.io/docs/latest/develop/connect/clients/python/redis-py/#example-indexing-and-querying-json-documents
 
 
+@metrics.timed("db_save")
 def db_save(r: redis.Redis, bot: TetrisBot, key: str = "bot"):
     bot_id = bot.id
     bot_dict = bot.to_dict()
@@ -13,11 +17,13 @@ def db_save(r: redis.Redis, bot: TetrisBot, key: str = "bot"):
     return r.set(f"{key}:{bot_id}", ser_bot)
 
 
+@metrics.timed("db_load")
 def db_load(r: redis.Redis, bot_id: int, key: str = "bot") -> TetrisBot:
     deser_bot = TetrisBot.from_dict(pickle.loads(r.get(f"{key}:{bot_id}")))
     return deser_bot
 
 
+@metrics.timed("db_save_all")
 def db_save_all(r: redis.Redis, bots: list[TetrisBot], key: str = "bot"):
     with r.pipeline() as pipe:
         pipe.multi()
@@ -26,16 +32,37 @@ def db_save_all(r: redis.Redis, bots: list[TetrisBot], key: str = "bot"):
         return all(pipe.execute())
 
 
+@metrics.timed("db_save_all_dict")
 def db_save_all_dict(r: redis.Redis, bots: list[dict], key: str = "bot"):
+    with metrics.timer("pickle"):
+        ser_bots = [(bot["id"], pickle.dumps(bot)) for bot in bots]
     with r.pipeline() as pipe:
         pipe.multi()
-        for bot in bots:
-            bot_id = bot["id"]
-            ser_bot = pickle.dumps(bot)
+        for bot_id, ser_bot in ser_bots:
             pipe.set(f"{key}:{bot_id}", ser_bot)
         return all(pipe.execute())
 
 
+@metrics.timed("db_save_render_frames")
+def db_save_render_frames(
+    r: redis.Redis, ser_bots: list[tuple[int, bytes]], key: str = "render_bot"
+):
+    """Save pickled render frames, by bot id, to one hash.
+
+    The server reads them all with one HGETALL, whichever bot ids the workers
+    have, instead of a KEYS and a GET per bot.
+    """
+    r.hset(key, mapping=dict(ser_bots))
+
+
+async def db_load_render_frames(
+    r: redis.asyncio.Redis, key: str = "render_bot"
+) -> list[dict]:
+    frames = await r.hgetall(key)
+    return [pickle.loads(frame) for frame in frames.values()]
+
+
+@metrics.timed("db_load_all")
 def db_load_all(
     r: redis.Redis, bot_ids: list[int], key: str = "bot"
 ) -> list[TetrisBot]:
@@ -52,6 +79,7 @@ def db_load_all(
     return bots
 
 
+@metrics.timed("db_load_all_dicts")
 def db_load_all_dicts(
     r: redis.Redis, bot_ids: list[int], key: str = "bot"
 ) -> list[dict]:
@@ -66,6 +94,7 @@ def db_load_all_dicts(
     return bots
 
 
+@metrics.timed("db_load_all_dicts_by_key")
 def db_load_all_dicts_by_key(r: redis.Redis, key: str = "bot") -> list[dict]:
     keys = r.keys(f"{key}:*")
     with r.pipeline() as pipe:
@@ -79,30 +108,145 @@ def db_load_all_dicts_by_key(r: redis.Redis, key: str = "bot") -> list[dict]:
     return bots
 
 
-def db_write_bots_fitness(r: redis.Redis, bots: list[TetrisBot]):
+@metrics.timed("db_save_children")
+def db_save_children(r: redis.Redis, bots: list[TetrisBot], generation: int):
+    """Save the bots bred in this generation's crossover, by bot id.
+
+    A worker that takes a bot over at the next generation loads it from here,
+    as `bot:{id}` still holds the brain its parent played with.
+    """
+    if not bots:
+        return
+    key = f"children:{generation}"
+    with metrics.timer("pickle"):
+        mapping = {
+            bot.id: pickle.dumps(bot.to_dict(with_weights=True)) for bot in bots
+        }
+    with r.pipeline() as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, 60 * 60)
+        pipe.execute()
+
+
+@metrics.timed("db_load_children")
+def db_load_children(
+    r: redis.Redis, bot_ids: list[int], generation: int
+) -> list[TetrisBot]:
+    if not bot_ids:
+        return []
+    ser_bots = r.hmget(f"children:{generation}", bot_ids)
+    return [
+        TetrisBot.from_dict(pickle.loads(ser_bot))
+        for ser_bot in ser_bots
+        if ser_bot is not None
+    ]
+
+
+@metrics.timed("db_write_bots_fitness")
+def db_write_bots_fitness(
+    r: redis.Redis, bots: list[TetrisBot], key: str = "bot_fitness"
+):
     # Write the bots' id and fitness pairs to a Redis list
     for bot in bots:
-        r.rpush("bot_fitness", f"{bot.id}:{bot.fitness}")
+        r.rpush(key, f"{bot.id}:{bot.fitness}")
+    r.expire(key, 60 * 60)
 
 
-def db_read_bots_fitness(r: redis.Redis, expected_size: int) -> list:
-    # Initialize a list of the expected size with None or some default value
+@metrics.timed("db_read_bots_fitness")
+def db_read_bots_fitness(
+    r: redis.Redis, expected_size: int, key: str = "bot_fitness"
+) -> list:
+    # Initialize a list of the expected size with None or some default value.
+    # Bots whose worker died before writing their fitness stay None.
     fitness_list = [None] * expected_size
 
-    # bot IDs
-    bot_ids = set()
-
     # Retrieve all entries from the Redis list
-    bot_fitness_list = r.lrange("bot_fitness", 0, -1)
+    bot_fitness_list = r.lrange(key, 0, -1)
 
     # Parse the list and populate the fitness values at the correct index
     for entry in bot_fitness_list:
         bot_id, fitness = entry.decode("utf-8").split(":")
         bot_id = int(bot_id)  # Convert bot_id to integer to use as an index
         fitness_list[bot_id] = float(fitness)  # Place fitness in the correct index
-        bot_ids.add(bot_id)
-
-    # assert that the number of bot_ids equals expected_size
-    assert len(bot_ids) == expected_size, "not enough fitness values"
 
     return fitness_list
+
+
+@metrics.timed("db_publish_genomes")
+def db_publish_genomes(
+    r: redis.Redis,
+    bots: list[TetrisBot],
+    genome_ttl: int,
+    stale_genome_ttl: int,
+    key: str = "pool",
+) -> list[int]:
+    """Publish finished bots' brains and fitness to the steady-state pool.
+
+    Genome keys are versioned, so a reader never gets a brain that was replaced
+    halfway through reading the pool. A bot's previous version is only kept for
+    stale_genome_ttl seconds, for the readers whose copy of the pool still
+    points at it.
+
+    Returns the versions of the published genomes.
+    """
+    if not bots:
+        return []
+
+    bot_ids = [bot.id for bot in bots]
+    with r.pipeline(transaction=False) as pipe:
+        pipe.incrby("genome_version", len(bots))
+        pipe.hmget(key, bot_ids)
+        last_version, previous_entries = pipe.execute()
+    versions = list(range(last_version - len(bots) + 1, last_version + 1))
+
+    with metrics.timer("pickle"):
+        genomes = [pickle.dumps(bot.brain.to_dict()) for bot in bots]
+    now = time.time()
+    with r.pipeline() as pipe:
+        for bot, version, genome in zip(bots, versions, genomes):
+            pipe.set(f"genome:{bot.id}:{version}", genome, ex=genome_ttl)
+        for bot_id, entry in zip(bot_ids, previous_entries):
+            if entry is not None:
+                previous_version = entry.decode("utf-8").split(":")[0]
+                pipe.expire(f"genome:{bot_id}:{previous_version}", stale_genome_ttl)
+        pipe.hset(
+            key,
+            mapping={
+                bot.id: f"{version}:{bot.fitness}:{now}"
+                for bot, version in zip(bots, versions)
+            },
+        )
+        pipe.execute()
+    return versions
+
+
+@metrics.timed("db_read_genome_pool")
+def db_read_genome_pool(
+    r: redis.Redis, max_age: float, key: str = "pool"
+) -> list[tuple[int, int, float]]:
+    """Read (bot id, version, fitness) for every genome in the pool that is
+    younger than max_age seconds."""
+    now = time.time()
+    pool = []
+    for bot_id, entry in r.hgetall(key).items():
+        version, fitness, published_at = entry.decode("utf-8").split(":")
+        if now - float(published_at) <= max_age:
+            pool.append((int(bot_id), int(version), float(fitness)))
+    return pool
+
+
+@metrics.timed("db_load_genomes")
+def db_load_genomes(
+    r: redis.Redis, genome_keys: list[tuple[int, int]]
+) -> dict[tuple[int, int], dict]:
+    """Load brain dicts by (bot id, version). Expired genomes are left out."""
+    with r.pipeline() as pipe:
+        pipe.multi()
+        for bot_id, version in genome_keys:
+            pipe.get(f"genome:{bot_id}:{version}")
+        serialized_genomes = pipe.execute()
+    return {
+        genome_key: pickle.loads(genome_data)
+        for genome_key, genome_data in zip(genome_keys, serialized_genomes)
+        if genome_data is not None
+    }
@@ -0,0 +1,190 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+from app.metrics import metrics
+from app.shared_population import SharedPopulation
+from app.tetris_brain import TetrisBrain
+from app.tetris_engine import TetrisEngine
+from dotenv import load_dotenv
+
+load_dotenv()
+# Processes that a worker splits its bots between, 1 means play them in the
+# worker's own process.
+EVALUATION_PROCESSES = int(os.getenv("EVALUATION_PROCESSES", 1))
+# How often the bots' frames are published while the pool is playing.
+RENDER_INTERVAL = 0.05
+# Every evaluation process gets a core, so each library gets one thread.
+THREAD_COUNT_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def metrics_delta(before: dict, after: dict) -> dict:
+    return {
+        section: {
+            name: value - before[section].get(name, 0)
+            for name, value in after[section].items()
+        }
+        for section in ["phase_seconds", "phase_calls", "counters"]
+    }
+
+
+def evaluation_process(cpu: int, spec: dict, tasks, results, log_file: str | None):
+    """Play the shards of bots the worker sends, until it sends None."""
+    os.sched_setaffinity(0, {cpu})
+    if log_file:
+        logging.basicConfig(filename=log_file, level=logging.INFO)
+
+    import torch
+
+    torch.set_num_threads(1)
+
+    from app.tetris_bot import TetrisBot
+    from app.worker import play_generation
+
+    population = SharedPopulation(**spec)
+    width, height = population.width, population.height
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        rows, bot_count = task
+
+        before = metrics.snapshot()
+        bots = [
+            TetrisBot(
+                int(population.ids[row]),
+                width,
+                height,
+                brain=TetrisBrain.from_vector(width, height, population.genomes[row]),
+            )
+            for row in rows
+        ]
+        rows_by_id = {bot.id: row for bot, row in zip(bots, rows)}
+
+        def write_frames(playing_bots: list[TetrisBot]):
+            for bot in playing_bots:
+                population.write_frame(rows_by_id[bot.id], bot)
+
+        def count_game_over() -> tuple[int, int]:
+            # the other processes' bots too, as the quorum is the worker's
+            return int(population.game_over[:bot_count].sum()), bot_count
+
+        counts = play_generation(bots, write_frames, count_game_over)
+        population.fitness[rows] = [bot.fitness for bot in bots]
+        results.put((counts, metrics_delta(before, metrics.snapshot())))
+
+
+class EvaluationPool:
+    """Plays a worker's bots in a pool of processes, one per core.
+
+    The bots' genomes go to the processes, and their fitness and frames come
+    back, through a SharedPopulation, so only the row numbers of each shard
+    are sent over a queue. The frames are published from the worker, which
+    keeps the only Redis client.
+    """
+
+    def __init__(self, processes: int, capacity: int, width: int, height: int):
+        parameter_count = len(TetrisBrain(width, height).to_vector())
+        self.population = SharedPopulation(capacity, width, height, parameter_count)
+        atexit.register(self.close)
+
+        # inherited by the processes, before they import torch
+        for variable in THREAD_COUNT_VARIABLES:
+            os.environ.setdefault(variable, "1")
+        log_file = next(
+            (
+                handler.baseFilename
+                for handler in logging.getLogger().handlers
+                if isinstance(handler, logging.FileHandler)
+            ),
+            None,
+        )
+
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        cpus = sorted(os.sched_getaffinity(0))
+        self.processes = [
+            context.Process(
+                target=evaluation_process,
+                args=(
+                    cpus[index % len(cpus)],
+                    self.population.spec(),
+                    self.tasks,
+                    self.results,
+                    log_file,
+                ),
+                daemon=True,
+            )
+            for index in range(processes)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def evaluate(self, bots: list, publish_frames) -> dict:
+        """Play a generation of the bots, like play_generation.
+
+        publish_frames is called with the frames that changed, as dicts,
+        about every RENDER_INTERVAL seconds.
+
+        Returns the loop and event count of the longest shard.
+        """
+        population = self.population
+        if len(bots) > population.size:
+            raise Exception(
+                f"{len(bots)} bots don't fit in a pool of {population.size}"
+            )
+
+        for row, bot in enumerate(bots):
+            population.ids[row] = bot.id
+            population.genomes[row] = bot.brain.to_vector().numpy()
+        # the processes check GAME_OVER_QUORUM against it before writing frames
+        population.game_over[: len(bots)] = False
+        published_versions = population.frame_versions[: len(bots)].copy()
+
+        shards = [
+            shard.tolist()
+            for shard in np.array_split(np.arange(len(bots)), len(self.processes))
+            if len(shard)
+        ]
+        for shard in shards:
+            self.tasks.put((shard, len(bots)))
+
+        all_counts = []
+        while len(all_counts) < len(shards):
+            try:
+                counts, delta = self.results.get(timeout=RENDER_INTERVAL)
+                all_counts.append(counts)
+                for phase, seconds in delta["phase_seconds"].items():
+                    metrics.add_time(phase, seconds, delta["phase_calls"][phase])
+                for name, value in delta["counters"].items():
+                    metrics.inc(name, value)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise Exception("An evaluation process died")
+
+            versions = population.frame_versions[: len(bots)]
+            changed = np.flatnonzero(versions != published_versions)
+            if len(changed):
+                published_versions[changed] = versions[changed]
+                publish_frames([population.read_frame(row) for row in changed])
+
+        for row, bot in enumerate(bots):
+            bot.fitness = int(population.fitness[row])
+            # only used for rendering, like the engines from Redis
+            bot.engine = TetrisEngine.from_dict(population.read_frame(row)["engine"])
+
+        return max(
+            all_counts,
+            key=lambda counts: (counts["loop_count"], counts["event_count"]),
+        )
+
+    def close(self):
+        for _process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+        self.population.close()
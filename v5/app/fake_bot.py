@@ -44,6 +44,10 @@ class TetrisBot:
             return True
         return False
 
+    @property
+    def fitness(self) -> float:
+        return self.state["acc"]
+
     def get_state(self):
         return {"id": self.id, "state": self.state, "engine": self.engine.to_dict()}
 
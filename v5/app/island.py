@@ -0,0 +1,90 @@
+import os
+import pickle
+import random
+
+from app.coordinator import Membership
+from app.redis_io import redis_client
+from app.tetris_bot import TetrisBot
+from app.tetris_brain import TetrisBrain
+from app.worker_util import fitness_stats, log, weighted_selection
+from dotenv import load_dotenv
+
+load_dotenv()
+# Every MIGRATION_INTERVAL generations, each island publishes its MIGRATION_SIZE
+# fittest genomes and takes in the ones published by its neighbours.
+MIGRATION_INTERVAL = int(os.getenv("MIGRATION_INTERVAL", 10))
+MIGRATION_SIZE = int(os.getenv("MIGRATION_SIZE", 5))
+# "ring", "random" or "full"
+MIGRATION_TOPOLOGY = os.getenv("MIGRATION_TOPOLOGY", "ring")
+r = redis_client()
+
+
+def crossover_locally(bots: list[TetrisBot]) -> dict:
+    """Like crossover_with_fittest, but the parents only come from this island."""
+    all_fitness = [bot.fitness for bot in bots]
+    total_fitness = sum(all_fitness)
+    stats = fitness_stats(all_fitness)
+
+    for bot in bots:
+        parent_a = bots[weighted_selection(all_fitness, total_fitness)]
+        parent_b = bots[weighted_selection(all_fitness, total_fitness)]
+        bot.crossover(parent_a, parent_b)
+
+    return stats
+
+
+def neighbours(name: str, islands: list[str]) -> list[str]:
+    """The islands this island takes migrants from, for MIGRATION_TOPOLOGY."""
+    others = [island for island in islands if island != name]
+    if not others:
+        return []
+
+    if MIGRATION_TOPOLOGY == "full":
+        return others
+    if MIGRATION_TOPOLOGY == "random":
+        return [random.choice(others)]
+    if MIGRATION_TOPOLOGY == "ring":
+        if name not in islands:
+            return [others[-1]]
+        return [islands[islands.index(name) - 1]]
+
+    raise ValueError(f"Unknown MIGRATION_TOPOLOGY: {MIGRATION_TOPOLOGY}")
+
+
+def migrate(
+    bots: list[TetrisBot], name: str, membership: Membership, generation: int
+):
+    """Swap the fittest genomes with the neighbouring islands.
+
+    Must be called after crossover and before reinit: the fittest current
+    brains are published, and the migrants replace the next brains of the
+    least fit bots.
+    """
+    if generation % MIGRATION_INTERVAL != 0:
+        return
+
+    fittest_bots = sorted(bots, key=lambda bot: bot.fitness, reverse=True)
+    emigrants = [
+        (bot.fitness, bot.brain.to_dict()) for bot in fittest_bots[:MIGRATION_SIZE]
+    ]
+    r.set(f"migrants:{name}", pickle.dumps(emigrants), ex=60 * 60)
+
+    # the neighbours may not have reached this generation yet, in which
+    # case their previous migrants are taken in
+    neighbour_names = neighbours(name, membership.live_members())
+    immigrants = [
+        immigrant
+        for migrants in r.mget([f"migrants:{island}" for island in neighbour_names])
+        if migrants is not None
+        for immigrant in pickle.loads(migrants)
+    ]
+    immigrants = sorted(immigrants, key=lambda immigrant: immigrant[0], reverse=True)
+    immigrants = immigrants[: min(MIGRATION_SIZE, len(bots) // 2)]
+
+    least_fit_bots = fittest_bots[::-1]
+    for bot, (_fitness, brain_dict) in zip(least_fit_bots, immigrants):
+        bot.next_brain = TetrisBrain.from_dict(bot.width, bot.height, brain_dict)
+
+    log(
+        f"migration: generation={generation}, neighbours={len(neighbour_names)}, immigrants={len(immigrants)}"
+    )
@@ -0,0 +1,178 @@
+"""Run the generational algorithm on one machine, without Redis.
+
+N worker processes share the population through shared memory (see
+app/shared_population.py) and wait for each other at multiprocessing
+barriers, instead of going through Redis:
+
+    python -m app.local_runner --workers 8 --bots-per-worker 10
+
+To watch it, start the server on the same machine with the same
+LOCAL_POPULATION, and it reads the frames straight from shared memory:
+
+    LOCAL_POPULATION=tetris-population uvicorn app.server:app
+
+The workers log to --log-dir (logs) like the Redis workers, so app/plot.py works
+too.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# The name of the shared memory block, for the server to find it.
+LOCAL_POPULATION = os.getenv("LOCAL_POPULATION", "tetris-population")
+
+
+def run_worker(
+    index: int,
+    bots_per_worker: int,
+    generations: int,
+    seed: int,
+    barrier,
+    log_dir: str,
+):
+    import torch
+
+    random.seed(seed + index)
+    torch.manual_seed(seed + index)
+    torch.set_num_threads(1)
+    logging.basicConfig(filename=f"{log_dir}/worker-{index}.log", level=logging.INFO)
+
+    from app.metrics import metrics
+    from app.records import GenerationLog
+    from app.shared_population import SharedPopulation
+    from app.tetris_bot import TetrisBot
+    from app.tetris_brain import TetrisBrain
+    from app.worker import crossover_with_fittest, play_generation, record_throughput
+
+    population = SharedPopulation.attach(LOCAL_POPULATION)
+    width, height = population.width, population.height
+    rows = range(index * bots_per_worker, (index + 1) * bots_per_worker)
+    # a bot's id is its row
+    bots = [TetrisBot(row, width, height) for row in rows]
+    generation_log = GenerationLog(f"{log_dir}/generations-{index}.jsonl")
+
+    def write_frames(playing_bots: list[TetrisBot]):
+        for bot in playing_bots:
+            population.write_frame(bot.id, bot)
+
+    def read_fitness() -> list[float]:
+        return population.fitness.tolist()
+
+    def load_parents(bot_ids: list[int]) -> list[TetrisBot]:
+        return [
+            TetrisBot(
+                bot_id,
+                width,
+                height,
+                brain=TetrisBrain.from_vector(width, height, population.genomes[bot_id]),
+            )
+            for bot_id in bot_ids
+        ]
+
+    for generation in range(1, generations + 1):
+        started_at = time.time()
+        moves_before = metrics.counter("moves")
+        counts = play_generation(bots, write_frames)
+        record_throughput(
+            len(bots), metrics.counter("moves") - moves_before, time.time() - started_at
+        )
+        for bot in bots:
+            population.genomes[bot.id] = bot.brain.to_vector().numpy()
+            population.fitness[bot.id] = bot.fitness
+
+        # every genome and fitness of this generation has been written
+        barrier.wait()
+        stats = crossover_with_fittest(bots, generation, read_fitness, load_parents)
+        # every worker has its parents, so the genomes can be overwritten
+        barrier.wait()
+
+        generation_log.append(
+            {"worker": index, "generation": generation, **stats, **counts}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("NUMBER_OF_WORKERS", 1))
+    )
+    parser.add_argument(
+        "--bots-per-worker", type=int, default=int(os.getenv("BOTS_PER_WORKER", 1))
+    )
+    parser.add_argument(
+        "--generations", type=int, default=int(os.getenv("MAX_GENERATIONS", 0))
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-dir", default="logs")
+    args = parser.parse_args()
+
+    # inherited by the workers, for the budgets and POPULATION_SIZE in app/worker.py
+    os.environ["NUMBER_OF_WORKERS"] = str(args.workers)
+    os.environ["BOTS_PER_WORKER"] = str(args.bots_per_worker)
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ.setdefault(variable, "1")
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    from app.shared_population import SharedPopulation
+    from app.tetris_brain import TetrisBrain
+
+    width, height = 10, 10
+    parameter_count = len(TetrisBrain(width, height).to_vector())
+    population_size = args.workers * args.bots_per_worker
+    try:
+        population = SharedPopulation(
+            population_size, width, height, parameter_count, LOCAL_POPULATION, True
+        )
+    except FileExistsError:
+        # left behind by a run that was killed
+        SharedPopulation.attach(LOCAL_POPULATION).shm.unlink()
+        population = SharedPopulation(
+            population_size, width, height, parameter_count, LOCAL_POPULATION, True
+        )
+    population.ids[:] = range(population_size)
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.workers)
+    # 0 generations means run until stopped
+    generations = args.generations or 2**62
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(
+                index,
+                args.bots_per_worker,
+                generations,
+                args.seed,
+                barrier,
+                args.log_dir,
+            ),
+        )
+        for index in range(args.workers)
+    ]
+    started_at = time.perf_counter()
+    try:
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                # don't leave the others waiting at a barrier forever
+                barrier.abort()
+            time.sleep(0.1)
+    finally:
+        for worker in workers:
+            worker.join()
+        population.close()
+
+    seconds = time.perf_counter() - started_at
+    print(f"{args.generations} generations in {seconds:.2f}s, logs in {args.log_dir}")
+
+
+if __name__ == "__main__":
+    main()
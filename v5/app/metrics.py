@@ -0,0 +1,205 @@
+import copy
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+# Upper bounds (in seconds) of the barrier wait histogram buckets.
+BARRIER_WAIT_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+class Metrics:
+    """Timers, counters and histograms for one worker.
+
+    Everything is cumulative, like Prometheus counters, so a snapshot can be
+    published at any time and the rates are worked out by whoever scrapes it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase_seconds: dict[str, float] = {}
+        self.phase_calls: dict[str, int] = {}
+        self.counters: dict[str, float] = {}
+        # name -> Prometheus label string, e.g. 'call_site="x",prefix="bot"' -> value
+        self.labelled_counters: dict[str, dict[str, float]] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, dict] = {}
+
+    def add_time(self, phase: str, seconds: float, calls: int = 1):
+        with self.lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+            self.phase_calls[phase] = self.phase_calls.get(phase, 0) + calls
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def timed(self, phase: str):
+        """Decorator version of timer."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def inc(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def inc_labelled(self, name: str, labels: dict[str, str], value: float = 1):
+        label_string = ",".join(f'{label}="{labels[label]}"' for label in labels)
+        with self.lock:
+            counters = self.labelled_counters.setdefault(name, {})
+            counters[label_string] = counters.get(label_string, 0) + value
+
+    def counter(self, name: str) -> float:
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def set(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets: list[float]):
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                name,
+                {
+                    "buckets": buckets,
+                    "counts": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                },
+            )
+            for index, upper_bound in enumerate(histogram["buckets"]):
+                if value <= upper_bound:
+                    histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return copy.deepcopy(
+                {
+                    "phase_seconds": self.phase_seconds,
+                    "phase_calls": self.phase_calls,
+                    "counters": self.counters,
+                    "labelled_counters": self.labelled_counters,
+                    "gauges": self.gauges,
+                    "histograms": self.histograms,
+                }
+            )
+
+    def publish(self, r: redis.Redis, worker: str):
+        """Share this worker's metrics, for the server's /metrics endpoint."""
+        r.hset("metrics", worker, json.dumps(self.snapshot()))
+
+
+def read_all_metrics(r: redis.Redis) -> dict[str, dict]:
+    return parse_all_metrics(r.hgetall("metrics"))
+
+
+def parse_all_metrics(snapshots: dict[bytes, bytes]) -> dict[str, dict]:
+    """Every worker's metrics, from the "metrics" hash."""
+    return {
+        worker.decode("utf-8"): json.loads(snapshot)
+        for worker, snapshot in snapshots.items()
+    }
+
+
+def to_prometheus(all_metrics: dict[str, dict]) -> str:
+    """Render every worker's metrics in the Prometheus text format."""
+    lines = [
+        "# HELP tetris_phase_seconds_total Time spent in each phase.",
+        "# TYPE tetris_phase_seconds_total counter",
+    ]
+    for worker, snapshot in all_metrics.items():
+        for phase, seconds in snapshot["phase_seconds"].items():
+            lines.append(
+                f'tetris_phase_seconds_total{{worker="{worker}",phase="{phase}"}} {seconds}'
+            )
+
+    lines += [
+        "# HELP tetris_phase_calls_total Number of times each phase ran.",
+        "# TYPE tetris_phase_calls_total counter",
+    ]
+    for worker, snapshot in all_metrics.items():
+        for phase, calls in snapshot["phase_calls"].items():
+            lines.append(
+                f'tetris_phase_calls_total{{worker="{worker}",phase="{phase}"}} {calls}'
+            )
+
+    counter_names = sorted(
+        {name for snapshot in all_metrics.values() for name in snapshot["counters"]}
+    )
+    for name in counter_names:
+        lines.append(f"# TYPE tetris_{name}_total counter")
+        for worker, snapshot in all_metrics.items():
+            if name in snapshot["counters"]:
+                value = snapshot["counters"][name]
+                lines.append(f'tetris_{name}_total{{worker="{worker}"}} {value}')
+
+    labelled_counter_names = sorted(
+        {
+            name
+            for snapshot in all_metrics.values()
+            for name in snapshot.get("labelled_counters", {})
+        }
+    )
+    for name in labelled_counter_names:
+        lines.append(f"# TYPE tetris_{name}_total counter")
+        for worker, snapshot in all_metrics.items():
+            counters = snapshot.get("labelled_counters", {}).get(name, {})
+            for label_string, value in counters.items():
+                lines.append(
+                    f'tetris_{name}_total{{worker="{worker}",{label_string}}} {value}'
+                )
+
+    gauge_names = sorted(
+        {name for snapshot in all_metrics.values() for name in snapshot["gauges"]}
+    )
+    for name in gauge_names:
+        lines.append(f"# TYPE tetris_{name} gauge")
+        for worker, snapshot in all_metrics.items():
+            if name in snapshot["gauges"]:
+                value = snapshot["gauges"][name]
+                lines.append(f'tetris_{name}{{worker="{worker}"}} {value}')
+
+    histogram_names = sorted(
+        {name for snapshot in all_metrics.values() for name in snapshot["histograms"]}
+    )
+    for name in histogram_names:
+        lines.append(f"# TYPE tetris_{name} histogram")
+        for worker, snapshot in all_metrics.items():
+            histogram = snapshot["histograms"].get(name)
+            if histogram is None:
+                continue
+            for upper_bound, count in zip(histogram["buckets"], histogram["counts"]):
+                lines.append(
+                    f'tetris_{name}_bucket{{worker="{worker}",le="{upper_bound}"}} {count}'
+                )
+            lines.append(
+                f'tetris_{name}_bucket{{worker="{worker}",le="+Inf"}} {histogram["count"]}'
+            )
+            lines.append(f'tetris_{name}_sum{{worker="{worker}"}} {histogram["sum"]}')
+            lines.append(
+                f'tetris_{name}_count{{worker="{worker}"}} {histogram["count"]}'
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+# One per process, shared by the worker, the coordinator and db.py.
+metrics = Metrics()
@@ -1,139 +1,169 @@
-# import matplotlib.pyplot as plt
-# import numpy as np
-
-# # Open the log file and read the first float from each relevant line
-# """
-# INFO:root:loop_count=13, event_count=6
-# INFO:root:max_fitness: 371.0, min_fitness: 2.0, mean_fitness: 40.06333333333333
-# INFO:root:loop_count=18, event_count=9
-# INFO:root:max_fitness: 310.0, min_fitness: 2.0, mean_fitness: 46.163333333333334
-# """
-# with open("logs/worker-0") as f:
-#     values = [
-#         float(line.split("[")[1].split(",")[0]) for line in f if "top_n_fitness" in line
-#     ]
-
-# # Set the figure size for a high-resolution 1920x1080 plot (approx. 16:9 ratio)
-# plt.figure(figsize=(19.2, 10.8), dpi=100)
-
-# # Plot the original values
-# plt.plot(values, label="Original")
-
-# # Calculate and plot the moving average
-# for maco in [(20, "yellow"), (50, "orange"), (100, "red")]:
-#     ma, color = maco
-#     moving_avg = np.convolve(values, np.ones(ma) / ma, mode="valid")
-#     plt.plot(
-#         range(len(moving_avg)), moving_avg, label=f"Moving Average ({ma})", color=color
-#     )
-
-# # Add legend and save the plot
-# plt.legend()
-# plt.savefig("plot.png")
-
-
 import glob
+import hashlib
+import json
+import os
+import pickle
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-# Get the list of log files from the "logs" directory
-log_files = glob.glob("logs/*.log")
-
-# Initialize variables for fitness values from the first log
-min_fitness = []
-mean_fitness = []
-max_fitness = []
-
-# Initialize variables for loop counts from all logs
-loop_counts = {}
-
-# Read the first log for fitness values
-with open(log_files[0], "r") as f:
-    for line in f:
-        if "max_fitness" in line:
-            parts = line.split(",")
-            max_fitness.append(float(parts[0].split(":")[3].strip()))
-            min_fitness.append(float(parts[1].split(":")[1].strip()))
-            mean_fitness.append(float(parts[2].split(":")[1].strip()))
-
-# Read all logs for loop counts
-for log_file in log_files:
-    with open(log_file, "r") as f:
-        for line in f:
-            if "loop_count" in line:
-                loop_count = int(line.split(",")[0].split("=")[1])
-                loop_counts.setdefault(log_file, []).append(loop_count)
-
-# Calculate statistics for loop counts
-max_loop_counts = []
-min_loop_counts = []
-mean_loop_counts = []
-
-for i in range(len(loop_counts[log_files[0]])):
-    _loop_counts = []
-
-    for k, v in loop_counts.items():
-        # check if v is long enough
-        if len(v) > i:
-            _loop_counts.append(v[i])
-        else:
-            _loop_counts.append(v[i - 1])
-
-    max_loop_counts.append(max(_loop_counts))
-    min_loop_counts.append(min(_loop_counts))
-    mean_loop_counts.append(sum(_loop_counts) / len(_loop_counts))
-
-# Plot the values
-plt.figure(figsize=(19.2, 10.8), dpi=100)
-
-# Plot fitness values
-
-max_fitness_moving_avg = np.convolve(max_fitness, np.ones(20) / 20, mode="valid")
-# plt.plot(max_fitness, label="Max Fitness", color="tab:blue")
-plt.plot(
-    range(len(max_fitness_moving_avg)),
-    max_fitness_moving_avg,
-    label="Max Fitness",
-    color="tab:blue",
-)
-
-mean_fitness_moving_avg = np.convolve(mean_fitness, np.ones(20) / 20, mode="valid")
-# plt.plot(mean_fitness, label="Mean Fitness", color="tab:cyan")
-plt.plot(
-    range(len(mean_fitness_moving_avg)),
-    mean_fitness_moving_avg,
-    label="Mean Fitness",
-    color="tab:cyan",
-)
-
-min_fitness_moving_avg = np.convolve(min_fitness, np.ones(20) / 20, mode="valid")
-# plt.plot(min_fitness, label="Min Fitness", color="tab:purple")
-plt.plot(
-    range(len(min_fitness_moving_avg)),
-    min_fitness_moving_avg,
-    label="Min Fitness",
-    color="tab:purple",
-)
-
-# Plot loop counts
-max_loop_counts_moving_avg = np.convolve(
-    max_loop_counts, np.ones(20) / 20, mode="valid"
-)
-# plt.plot(max_loop_counts, label="Max Loop Count", color="tab:pink")
-plt.plot(
-    range(len(max_loop_counts_moving_avg)),
-    max_loop_counts_moving_avg,
-    label="Max Loop Count",
-    color="tab:pink",
-)
-
-# Add legend and labels
-plt.legend()
-plt.title("Fitness and Loop Count Statistics")
-plt.xlabel("Iterations")
-plt.ylabel("Values")
-
-# Save and show the plot
-plt.savefig("plot.png")
-plt.show()
+# The workers write one JSON line per generation to logs/generations-*.jsonl
+# (see app/records.py). Only the lines added since the last run are parsed:
+# the columns read so far and the offset into each file are kept in STATE_FILE.
+LOG_DIR = "logs"
+STATE_FILE = os.path.join(LOG_DIR, ".plot-state.pkl")
+COLUMNS = [
+    "worker",
+    "generation",
+    "max_fitness",
+    "min_fitness",
+    "mean_fitness",
+    "loop_count",
+]
+MOVING_AVERAGE = 20
+
+
+def empty_columns() -> dict:
+    return {column: np.empty(0, dtype=np.float64) for column in COLUMNS}
+
+
+def load_state() -> dict:
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, "rb") as f:
+            state = pickle.load(f)
+        # an older version didn't keep the columns per file, so start over
+        if "files" in state:
+            return state
+    return {"files": {}}
+
+
+def save_state(state: dict):
+    with open(f"{STATE_FILE}.tmp", "wb") as f:
+        pickle.dump(state, f)
+    os.replace(f"{STATE_FILE}.tmp", STATE_FILE)
+
+
+def file_identity(log_file: str) -> tuple:
+    """The inode and first line of the file, which change when it's replaced.
+
+    The first line is compared too, as a file truncated and written again in
+    place (or a new file that reuses the inode) keeps the inode.
+    """
+    with open(log_file, "rb") as f:
+        first_line = f.readline()
+        return os.fstat(f.fileno()).st_ino, hashlib.sha1(first_line).hexdigest()
+
+
+def read_new_records(state: dict):
+    """Read the records written to each file since the last run into state.
+
+    The columns are kept per file, so a file that was replaced (e.g. by a new
+    run) or removed takes the records read from it with it.
+    """
+    log_files = sorted(glob.glob(os.path.join(LOG_DIR, "generations-*.jsonl")))
+    for log_file in set(state["files"]) - set(log_files):
+        del state["files"][log_file]
+
+    for log_file in log_files:
+        identity = file_identity(log_file)
+        file_state = state["files"].get(log_file)
+        if (
+            file_state is None
+            or file_state["identity"] != identity
+            or os.path.getsize(log_file) < file_state["offset"]
+        ):
+            file_state = {"identity": identity, "offset": 0, "columns": empty_columns()}
+            state["files"][log_file] = file_state
+
+        new_columns = {column: [] for column in COLUMNS}
+        offset = file_state["offset"]
+        with open(log_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # still being written, so read it next time
+                    break
+                record = json.loads(line)
+                for column in COLUMNS:
+                    new_columns[column].append(record[column])
+                offset += len(line)
+        file_state["offset"] = offset
+
+        columns = file_state["columns"]
+        for column in COLUMNS:
+            new_values = np.asarray(new_columns[column], dtype=np.float64)
+            columns[column] = np.concatenate([columns[column], new_values])
+
+
+def all_columns(state: dict) -> dict:
+    """The columns of all the files read, one after the other."""
+    if not state["files"]:
+        return empty_columns()
+    return {
+        column: np.concatenate(
+            [file_state["columns"][column] for file_state in state["files"].values()]
+        )
+        for column in COLUMNS
+    }
+
+
+def per_generation(generation: np.ndarray, values: np.ndarray, reduce: str):
+    """Reduce the workers' values for each generation, with max, min or mean."""
+    generations, index = np.unique(generation, return_inverse=True)
+    if reduce == "max":
+        result = np.full(len(generations), -np.inf)
+        np.maximum.at(result, index, values)
+    elif reduce == "min":
+        result = np.full(len(generations), np.inf)
+        np.minimum.at(result, index, values)
+    else:
+        result = np.bincount(index, weights=values) / np.bincount(index)
+    return generations, result
+
+
+def moving_average(values: np.ndarray, window: int = MOVING_AVERAGE) -> np.ndarray:
+    if len(values) < window:
+        return values
+    cumsum = np.cumsum(np.insert(values, 0, 0.0))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def main():
+    state = load_state()
+    read_new_records(state)
+    save_state(state)
+
+    columns = all_columns(state)
+    if not len(columns["generation"]):
+        print(f"No generation records in {LOG_DIR}/generations-*.jsonl yet")
+        return
+
+    plt.figure(figsize=(19.2, 10.8), dpi=100)
+
+    # In generational mode all workers log the same fitness stats,
+    # in island mode every island has its own.
+    for column, reduce, label, color in [
+        ("max_fitness", "max", "Max Fitness", "tab:blue"),
+        ("mean_fitness", "mean", "Mean Fitness", "tab:cyan"),
+        ("min_fitness", "min", "Min Fitness", "tab:purple"),
+        ("loop_count", "max", "Max Loop Count", "tab:pink"),
+    ]:
+        _generations, values = per_generation(
+            columns["generation"], columns[column], reduce
+        )
+        values = moving_average(values)
+        plt.plot(range(len(values)), values, label=label, color=color)
+
+    # Add legend and labels
+    plt.legend()
+    plt.title("Fitness and Loop Count Statistics")
+    plt.xlabel("Iterations")
+    plt.ylabel("Values")
+
+    # Save and show the plot
+    plt.savefig("plot.png")
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+
+import redis
+from app.metrics import metrics
+from app.tetris_bot import TetrisBot
+from app.tetris_engine import TetrisEngine
+from app.worker_util import log
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/usr/src/app/logs")
+SAMPLE_INTERVAL = 0.005
+
+# Timed (and counted) with metrics while a session has "counters" on.
+HOT_PATHS = [
+    (TetrisEngine, "is_valid_move"),
+    (TetrisEngine, "update_grid"),
+    (TetrisBot, "get_game_state_as_inputs"),
+]
+
+
+class Sampler:
+    """A low-overhead sampling profiler for one thread.
+
+    Every SAMPLE_INTERVAL seconds it records the thread's stack, and writes
+    them in the collapsed stack format, for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.stacks: dict[str, int] = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack = ";".join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Profiles a worker for a few generations, when asked to over Redis.
+
+    Set `profile:{worker}` (or `profile:all`) to e.g.
+    {"generations": 5, "mode": "sample", "counters": true}, or use the server's
+    /profile endpoint. "mode" is "cprofile" (a .pstats file) or "sample"
+    (a .collapsed file), both written to PROFILE_DIR.
+    """
+
+    def __init__(self, r: redis.Redis, worker: int):
+        self.r = r
+        self.worker = worker
+        self.remaining_generations = 0
+        self.session = None
+        self.path = ""
+        self.originals = []
+        self.last_all_request = None
+
+    def before_generation(self, generation: int):
+        if self.session is not None:
+            return
+
+        request = self.r.getdel(f"profile:{self.worker}")
+        if request is None:
+            # "all" is left in place for the other workers, so every worker
+            # remembers which one it has already run
+            request = self.r.get("profile:all")
+            if request is None or request == self.last_all_request:
+                return
+            self.last_all_request = request
+        request = json.loads(request)
+
+        self.remaining_generations = int(request.get("generations", 1))
+        mode = request.get("mode", "cprofile")
+        extension = "pstats" if mode == "cprofile" else "collapsed"
+        self.path = os.path.join(
+            PROFILE_DIR, f"profile-{self.worker}-{generation}.{extension}"
+        )
+
+        if request.get("counters"):
+            for cls, name in HOT_PATHS:
+                original = getattr(cls, name)
+                self.originals.append((cls, name, original))
+                setattr(cls, name, metrics.timed(f"{cls.__name__}.{name}")(original))
+
+        if mode == "cprofile":
+            self.session = cProfile.Profile()
+            self.session.enable()
+        else:
+            self.session = Sampler(threading.get_ident())
+            self.session.start()
+        log(
+            f"profile: started, mode={mode}, "
+            f"generations={self.remaining_generations}, counters={bool(self.originals)}"
+        )
+
+    def after_generation(self):
+        if self.session is None:
+            return
+
+        self.remaining_generations -= 1
+        if self.remaining_generations > 0:
+            return
+
+        if isinstance(self.session, cProfile.Profile):
+            self.session.disable()
+            self.session.dump_stats(self.path)
+        else:
+            self.session.stop()
+            self.session.dump(self.path)
+        self.session = None
+
+        for cls, name, original in self.originals:
+            setattr(cls, name, original)
+        self.originals = []
+        log(f"profile: stopped, path={self.path}")
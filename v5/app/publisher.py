@@ -0,0 +1,86 @@
+import pickle
+import threading
+from typing import Callable
+
+import redis
+from app.db import db_save_render_frames
+from app.metrics import metrics
+
+
+class Publisher:
+    """Writes to Redis from a background thread, so the bots never wait on it.
+
+    Render frames go into a latest-value buffer with one frame per bot, so if
+    Redis falls behind the frontend skips frames, and the buffer never grows.
+    Other writes are queued as jobs, in order. flush() waits until everything
+    has been written.
+
+    An error in the background thread is raised by the next call.
+    """
+
+    def __init__(self, r: redis.Redis, render_key: str = "render_bot"):
+        self.r = r
+        self.render_key = render_key
+        self.frames: dict[int, bytes] = {}
+        self.jobs: list[Callable[[], None]] = []
+        self.busy = False
+        self.error: Exception | None = None
+        self.condition = threading.Condition()
+        self.thread: threading.Thread | None = None
+
+    def publish_frames(self, render_bots: list[dict]):
+        # pickled now, as the engines keep changing while the frames wait
+        with metrics.timer("pickle"):
+            frames = {bot["id"]: pickle.dumps(bot) for bot in render_bots}
+        with self.condition:
+            self.raise_error()
+            metrics.inc("dropped_frames", len(frames.keys() & self.frames.keys()))
+            self.frames.update(frames)
+            self.wake()
+
+    def submit(self, job: Callable[[], None]):
+        with self.condition:
+            self.raise_error()
+            self.jobs.append(job)
+            self.wake()
+
+    def flush(self):
+        with metrics.timer("publisher_flush"), self.condition:
+            self.condition.wait_for(
+                lambda: self.error or not (self.frames or self.jobs or self.busy)
+            )
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wake(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.frames or self.jobs)
+                frames, self.frames = self.frames, {}
+                jobs, self.jobs = self.jobs, []
+                self.busy = True
+
+            error = None
+            try:
+                if frames:
+                    db_save_render_frames(self.r, list(frames.items()), self.render_key)
+                for job in jobs:
+                    job()
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                self.busy = False
+                if error is not None:
+                    self.error = error
+                self.condition.notify_all()
@@ -0,0 +1,26 @@
+import json
+
+from app.metrics import metrics
+
+
+class GenerationLog:
+    """Machine-readable, append-only log with one JSON line per generation.
+
+    Each record also has the time spent in each phase since the previous
+    record, so app/plot.py never has to parse the free-text worker logs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_phase_seconds: dict[str, float] = {}
+
+    def append(self, record: dict):
+        phase_seconds = metrics.snapshot()["phase_seconds"]
+        record["phase_seconds"] = {
+            phase: seconds - self.last_phase_seconds.get(phase, 0.0)
+            for phase, seconds in phase_seconds.items()
+        }
+        self.last_phase_seconds = phase_seconds
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+
+import redis
+import redis.asyncio
+from app.metrics import metrics
+from dotenv import load_dotenv
+from redis.client import Pipeline
+
+load_dotenv()
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Count every Redis command, by call site and key prefix, see InstrumentedRedis.
+REDIS_IO_METRICS = os.getenv("REDIS_IO_METRICS", "1") == "1"
+# Connections in the server's pool, which handlers wait for when they're all busy.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 10))
+
+# Upper bounds of the histogram buckets.
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1]
+PIPELINE_SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+# Commands without a key, or whose first argument isn't one.
+KEYLESS_COMMANDS = {"PING", "INFO", "TIME", "FLUSHALL", "FLUSHDB", "MULTI", "EXEC"}
+
+
+def key_prefix(args: tuple) -> str:
+    """The part of a command's key before the first ":", e.g. "bot" for
+    "bot:42", or "tick" for "tick:6". Keys without one are used as they are."""
+    command = str(args[0]).upper()
+    if len(args) < 2 or command in KEYLESS_COMMANDS:
+        return "-"
+    if command == "KEYS":
+        return "keys"
+    key = args[1]
+    if isinstance(key, bytes):
+        key = key.decode("utf-8", "replace")
+    return str(key).split(":", 1)[0]
+
+
+def size_of(value) -> int:
+    """Roughly how many bytes a command argument or reply takes on the wire."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (list, tuple, set)):
+        return sum(size_of(item) for item in value)
+    if isinstance(value, dict):
+        return sum(size_of(key) + size_of(item) for key, item in value.items())
+    if value is None:
+        return 0
+    return len(str(value))
+
+
+def call_site() -> str:
+    """The name of the first function up the stack that isn't part of
+    redis-py or of this module, e.g. "db_load_all"."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if not (module.startswith("redis") or module == __name__):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "-"
+
+
+def record(site: str, commands: list[tuple], replies: list, seconds: float):
+    # a pipeline's time is split evenly between its commands
+    seconds_per_command = seconds / max(len(commands), 1)
+    for args, reply in zip(commands, replies):
+        labels = {"call_site": site, "prefix": key_prefix(args)}
+        metrics.inc_labelled("redis_commands", labels)
+        metrics.inc_labelled("redis_bytes_sent", labels, size_of(args))
+        metrics.inc_labelled("redis_bytes_received", labels, size_of(reply))
+        metrics.inc_labelled("redis_seconds", labels, seconds_per_command)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        commands = [args for args, _options in self.command_stack]
+        if not commands:
+            return super().execute(raise_on_error)
+        site = call_site()
+        start = time.perf_counter()
+        replies = super().execute(raise_on_error)
+        seconds = time.perf_counter() - start
+        record(site, commands, replies, seconds)
+        metrics.observe("redis_pipeline_size", len(commands), PIPELINE_SIZE_BUCKETS)
+        metrics.observe("redis_latency_seconds", seconds, LATENCY_BUCKETS)
+        return replies
+
+
+class InstrumentedRedis(redis.Redis):
+    """A Redis client that counts commands, bytes sent and received, and
+    seconds spent, by call site and key prefix, in the process's metrics.
+
+    Commands in a pipeline are counted when it is executed, and the pipeline
+    sizes go into a histogram.
+    """
+
+    def execute_command(self, *args, **options):
+        site = call_site()
+        start = time.perf_counter()
+        reply = super().execute_command(*args, **options)
+        seconds = time.perf_counter() - start
+        record(site, [args], [reply], seconds)
+        metrics.observe("redis_latency_seconds", seconds, LATENCY_BUCKETS)
+        return reply
+
+    def pipeline(self, transaction=True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedAsyncRedis(redis.asyncio.Redis):
+    """Like InstrumentedRedis, for the server's asyncio client."""
+
+    async def execute_command(self, *args, **options):
+        site = call_site()
+        start = time.perf_counter()
+        reply = await super().execute_command(*args, **options)
+        seconds = time.perf_counter() - start
+        record(site, [args], [reply], seconds)
+        metrics.observe("redis_latency_seconds", seconds, LATENCY_BUCKETS)
+        return reply
+
+
+def redis_client() -> redis.Redis:
+    """The Redis client for workers, the coordinator and the server."""
+    if REDIS_IO_METRICS:
+        return InstrumentedRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+    return redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+
+
+def async_redis_client() -> redis.asyncio.Redis:
+    """The server's Redis client, so handlers never block the event loop.
+
+    Its connections are pooled, and closed with the client's aclose().
+    """
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, db=0, max_connections=REDIS_MAX_CONNECTIONS
+    )
+    if REDIS_IO_METRICS:
+        return InstrumentedAsyncRedis.from_pool(pool)
+    return redis.asyncio.Redis.from_pool(pool)
@@ -1,13 +1,20 @@
+import asyncio
+import json
+import logging
 import os
 import time
 from contextlib import asynccontextmanager
 
-import redis
-from app.db_without_pipelines import db_load_all_dicts, db_load_all_dicts_by_key
+import redis.asyncio
+from app.db import db_load_render_frames
+from app.metrics import metrics as server_metrics
+from app.metrics import parse_all_metrics, to_prometheus
+from app.redis_io import async_redis_client
+from app.shared_population import SharedPopulation
 from app.tetris_bot import TetrisBot
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import Response
 from starlette.types import Scope
@@ -15,7 +22,13 @@ from starlette.types import Scope
 load_dotenv()
 NUMBER_OF_WORKERS = int(os.getenv("NUMBER_OF_WORKERS", 1))
 BOTS_PER_WORKER = int(os.getenv("BOTS_PER_WORKER", 1))
-r: redis.Redis = None
+# Set to read the frames from app/local_runner.py's shared memory, not Redis.
+LOCAL_POPULATION = os.getenv("LOCAL_POPULATION", "")
+# How often the latest frames are pushed to the WebSocket clients.
+BROADCAST_INTERVAL = float(os.getenv("BROADCAST_INTERVAL", 0.05))
+r: redis.asyncio.Redis = None
+# attached once, and again whenever the runner restarts with a new block
+local_population: SharedPopulation | None = None
 
 
 class NoCacheStaticFiles(StaticFiles):
@@ -31,7 +44,8 @@ class NoCacheStaticFiles(StaticFiles):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global r
-    r = redis.Redis(host="redis", port=6379, db=0)
+    r = async_redis_client()
+    broadcaster = asyncio.create_task(broadcast_frames())
 
     # smoke test redis:
     # bot_ids = bots = [bot_id for bot_id in range(3)]
@@ -43,6 +57,10 @@ async def lifespan(app: FastAPI):
     # print(db_load_all(r, bot_ids))
 
     yield
+    broadcaster.cancel()
+    await r.aclose()
+    if local_population is not None:
+        local_population.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -72,50 +90,146 @@ async def start(n: int = 10, f: str = ""):
 
 @app.get("/ping")
 async def ping():
-    return {"message": "pong", "redis": r.ping()}
+    return {"message": "pong", "redis": await r.ping()}
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format, with the metrics every worker last published to Redis,
+    # and the server's own Redis I/O
+    all_metrics = parse_all_metrics(await r.hgetall("metrics"))
+    all_metrics["server"] = server_metrics.snapshot()
+    return PlainTextResponse(
+        to_prometheus(all_metrics),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/profile")
+async def profile(
+    worker: str = "all",
+    generations: int = 1,
+    mode: str = "cprofile",
+    counters: bool = False,
+):
+    # Picked up by the worker(s) at the start of their next generation, see
+    # app/profiler.py. The output is written to their logs directory.
+    request = {
+        "generations": generations,
+        "mode": mode,
+        "counters": counters,
+        "requested_at": time.time(),
+    }
+    await r.set(f"profile:{worker}", json.dumps(request), ex=60 * 60)
+    return {"message": f"Profiling worker {worker}", "request": request}
 
 
 @app.get("/state")
 async def state():
 
-    latest_bot_states = db_load_all_dicts_by_key(r, "render_bot")
+    latest_bot_states = await load_latest_bot_states()
 
     return {"message": "Latest bot states", "latest_bot_states": latest_bot_states}
 
 
+async def load_latest_bot_states() -> list[dict]:
+    if not LOCAL_POPULATION:
+        return await db_load_render_frames(r)
+
+    population = attach_local_population()
+    if population is None:
+        return []
+    return [population.read_frame(row) for row in range(population.size)]
+
+
+def attach_local_population() -> SharedPopulation | None:
+    global local_population
+    if local_population is not None and not local_population.is_current():
+        local_population.close()
+        local_population = None
+    if local_population is None:
+        try:
+            # the server isn't in the runner's process tree, so it mustn't
+            # unlink the runner's block when it exits
+            local_population = SharedPopulation.attach(LOCAL_POPULATION, track=False)
+        except FileNotFoundError:
+            return None
+    return local_population
+
+
+async def broadcast_frames():
+    """Push the latest frames to every WebSocket client.
+
+    The frames are loaded and serialised once per BROADCAST_INTERVAL, however
+    many clients there are, and not at all when there are none.
+    """
+    while True:
+        started_at = time.perf_counter()
+        if manager.queues:
+            try:
+                latest_bot_states = await load_latest_bot_states()
+                message = json.dumps(latest_bot_states, separators=(",", ":"))
+                if message != manager.last_message:
+                    manager.broadcast(message)
+            except Exception:
+                logging.exception("Failed to broadcast the frames")
+        elapsed = time.perf_counter() - started_at
+        await asyncio.sleep(max(0, BROADCAST_INTERVAL - elapsed))
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    sender = asyncio.create_task(manager.send_frames(websocket))
     try:
         while True:
-            data = await websocket.receive_text()
-            if data == "tick":
-                latest_bot_states = db_load_all_dicts_by_key(r, "render_bot")
-                await manager.send(latest_bot_states, websocket)
-            else:
-                pass
+            # the frames are pushed, so whatever the client sends is ignored
+            await websocket.receive_text()
 
     except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
         manager.disconnect(websocket)
 
 
 class ConnectionManager:
+    """The WebSocket clients, which all get the frames broadcast_frames loads.
+
+    Every client has a queue of one frame, so a client that can't keep up
+    skips to the latest frame, instead of falling behind or holding up the
+    others.
+    """
+
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.queues: dict[WebSocket, asyncio.Queue] = {}
+        self.last_message: str | None = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=1)
+        # only changes are broadcast, so a new client starts with the last one
+        if self.last_message is not None:
+            queue.put_nowait(self.last_message)
+        self.queues[websocket] = queue
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-
-    async def send(self, message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
+        self.queues.pop(websocket, None)
+
+    def broadcast(self, message: str):
+        self.last_message = message
+        for queue in self.queues.values():
+            if queue.full():
+                # the client hasn't been sent the last one yet
+                queue.get_nowait()
+                server_metrics.inc("dropped_ws_frames")
+            queue.put_nowait(message)
+
+    async def send_frames(self, websocket: WebSocket):
+        queue = self.queues[websocket]
+        while True:
+            message = await queue.get()
+            await websocket.send_text(message)
 
 
 manager = ConnectionManager()
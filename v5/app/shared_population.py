@@ -0,0 +1,171 @@
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+PIECE_TYPES = ["I", "J", "L", "O", "S", "T", "Z"]
+# Grid cells are 0 (empty), 1 (piece in play) or a locked piece's type.
+CELL_VALUES = [0, 1, *PIECE_TYPES]
+CELL_CODES = {value: code for code, value in enumerate(CELL_VALUES)}
+
+
+class SharedPopulation:
+    """A population's genomes, fitness and render frames, in one block of
+    shared memory that any process on the machine can attach to by name.
+
+    Every bot has a row: its id, its genome as a flat float32 vector (see
+    TetrisBrain.to_vector), its fitness, and the last frame of its game. A
+    row's frame_version goes up every time its frame is written, so readers
+    can skip the rows that haven't changed. Frames are written without a
+    lock, as a torn frame only ever shows up in the frontend.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        width: int,
+        height: int,
+        parameter_count: int,
+        name: str | None = None,
+        create: bool | None = None,
+        track: bool = True,
+    ):
+        """Allocate a new block, or attach to the block with this name.
+
+        A name can be given with create=True too, so other processes can
+        find the block, e.g. the server in app/local_runner.py. A process
+        that attaches from outside the creator's process tree should pass
+        track=False, or its resource tracker unlinks the block when it exits.
+        """
+        if create is None:
+            create = name is None
+        self.size = size
+        self.width = width
+        self.height = height
+        self.parameter_count = parameter_count
+
+        fields = [
+            ("header", np.int64, (4,)),
+            ("ids", np.int64, (size,)),
+            ("fitness", np.float64, (size,)),
+            ("scores", np.int64, (size,)),
+            ("frame_versions", np.int64, (size,)),
+            ("game_over", np.bool_, (size,)),
+            ("grids", np.int8, (size, height, width)),
+            ("genomes", np.float32, (size, parameter_count)),
+        ]
+        offsets = []
+        nbytes = 0
+        for _name, dtype, shape in fields:
+            # keep every array 8-byte aligned
+            nbytes = (nbytes + 7) // 8 * 8
+            offsets.append(nbytes)
+            nbytes += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            if not track:
+                untrack(self.shm)
+
+        for (field, dtype, shape), offset in zip(fields, offsets):
+            setattr(
+                self,
+                field,
+                np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset),
+            )
+        if self.owner:
+            self.header[:] = [size, width, height, parameter_count]
+            self.frame_versions[:] = 0
+
+    @classmethod
+    def attach(cls, name: str, track: bool = True) -> "SharedPopulation":
+        """Attach to a block by name alone, as its sizes are in its header."""
+        shm = shared_memory.SharedMemory(name=name)
+        if not track:
+            untrack(shm)
+        size, width, height, parameter_count = np.ndarray(
+            (4,), dtype=np.int64, buffer=shm.buf
+        ).tolist()
+        shm.close()
+        return cls(
+            size, width, height, parameter_count, name=name, create=False, track=track
+        )
+
+    def is_current(self) -> bool:
+        """Whether the block still has its name, as the process that created
+        it may have unlinked it and created a new one, e.g. when it restarts.
+        """
+        try:
+            return (
+                os.stat(f"/dev/shm/{self.shm.name}").st_ino
+                == os.fstat(self.shm._fd).st_ino
+            )
+        except FileNotFoundError:
+            return False
+
+    def spec(self) -> dict:
+        """What another process needs to attach, with SharedPopulation(**spec)."""
+        return {
+            "size": self.size,
+            "width": self.width,
+            "height": self.height,
+            "parameter_count": self.parameter_count,
+            "name": self.shm.name,
+        }
+
+    def write_frame(self, row: int, bot):
+        engine = bot.engine
+        self.grids[row] = [[CELL_CODES[cell] for cell in line] for line in engine.grid]
+        self.scores[row] = engine.total_score
+        self.game_over[row] = engine.is_game_over
+        self.fitness[row] = bot.fitness
+        self.frame_versions[row] += 1
+
+    def read_frame(self, row: int) -> dict:
+        """The frame in the same format as TetrisBot.to_dict(), for rendering."""
+        return {
+            "id": int(self.ids[row]),
+            "width": self.width,
+            "height": self.height,
+            "engine": {
+                "width": self.width,
+                "height": self.height,
+                "score": int(self.scores[row]),
+                "is_game_over": bool(self.game_over[row]),
+                "grid": [
+                    [CELL_VALUES[code] for code in line]
+                    for line in self.grids[row].tolist()
+                ],
+            },
+            "fitness": int(self.fitness[row]),
+        }
+
+    def close(self):
+        # the arrays have to go before the memory they point into
+        for field in [
+            "header",
+            "ids",
+            "fitness",
+            "scores",
+            "frame_versions",
+            "game_over",
+            "grids",
+            "genomes",
+        ]:
+            setattr(self, field, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def untrack(shm: shared_memory.SharedMemory):
+    """Stop this process's resource tracker from unlinking the block on exit.
+
+    Until Python 3.13, attaching to a block registers it with the tracker
+    just like creating it does.
+    """
+    resource_tracker.unregister(shm._name, "shared_memory")
@@ -0,0 +1,222 @@
+"""Stress the coordination layer with many fake workers.
+
+Every fake worker is a process running the real Coordinator barriers and db
+calls, but with the FakeEngine bots from app/fake_bot.py instead of the
+neural network, so hundreds of them fit on one machine. For each worker
+count it reports the barrier latency (from the last worker arriving to each
+worker getting through), and how long publishing fitness, reading it back
+and fetching parents from the other workers take:
+
+    python -m app.simulate --workers 50 100 200 --generations 3
+
+Like app/benchmark.py it runs against a local redis-server, or fakeredis.
+Linux only, as the workers are forked.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from app.benchmark import free_port, start_redis
+
+
+async def simulate_worker(
+    index: int,
+    number_of_workers: int,
+    bots_per_worker: int,
+    generations: int,
+    genome_bytes: int,
+):
+    from app.coordinator import Coordinator, r
+    from app.db import (
+        db_load_all_dicts,
+        db_read_bots_fitness,
+        db_save_all_dict,
+        db_write_bots_fitness,
+    )
+    from app.fake_bot import TetrisBot
+    from app.worker_util import weighted_selection
+
+    c = Coordinator(number_of_workers, name=f"sim-{index:04d}")
+    population_size = number_of_workers * bots_per_worker
+    # stands in for the pickled brain, which is most of a real bot's size
+    genome = b"\0" * genome_bytes
+    samples = []
+
+    tick = c.join() - 1
+    for _ in range(generations):
+        arrived_at = time.time()
+        await c.wait_for_all_workers(tick := tick + 1)
+        barriers = [(tick, arrived_at, time.time())]
+        generation = tick // 2
+        bots = [
+            TetrisBot(bot_id) for bot_id in c.assigned_bot_ids(tick, population_size)
+        ]
+
+        started_at = time.perf_counter()
+        for bot in bots:
+            while bot.think_then_move(True):
+                pass
+        evaluate_seconds = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        db_save_all_dict(r, [{**bot.to_dict(), "brain": genome} for bot in bots])
+        db_write_bots_fitness(r, bots, f"bot_fitness:{generation}")
+        publish_seconds = time.perf_counter() - started_at
+
+        arrived_at = time.time()
+        await c.wait_for_all_workers(tick := tick + 1)
+        barriers.append((tick, arrived_at, time.time()))
+
+        started_at = time.perf_counter()
+        all_fitness = db_read_bots_fitness(
+            r, population_size, f"bot_fitness:{generation}"
+        )
+        read_fitness_seconds = time.perf_counter() - started_at
+
+        all_fitness = [fitness or 0.0 for fitness in all_fitness]
+        total_fitness = sum(all_fitness)
+        own_ids = {bot.id for bot in bots}
+        parent_ids = {
+            weighted_selection(all_fitness, total_fitness)
+            for _ in range(2 * len(bots))
+        } - own_ids
+        started_at = time.perf_counter()
+        db_load_all_dicts(r, list(parent_ids))
+        fetch_parents_seconds = time.perf_counter() - started_at
+
+        samples.append(
+            {
+                "generation": generation,
+                "barriers": barriers,
+                "evaluate": evaluate_seconds,
+                "publish_fitness": publish_seconds,
+                "read_fitness": read_fitness_seconds,
+                "fetch_parents": fetch_parents_seconds,
+                "parents_fetched": len(parent_ids),
+            }
+        )
+
+    r.rpush("simulation", json.dumps(samples))
+
+
+def run_fake_worker(index: int, *args):
+    asyncio.run(simulate_worker(index, *args))
+
+
+def summarize(all_samples: list[list[dict]]) -> dict:
+    """Percentiles of each measurement, over all workers and generations."""
+    arrivals: dict[int, list[float]] = {}
+    for samples in all_samples:
+        for sample in samples:
+            for tick, arrived_at, _released_at in sample["barriers"]:
+                arrivals.setdefault(tick, []).append(arrived_at)
+    last_arrival = {tick: max(times) for tick, times in arrivals.items()}
+
+    barrier_latency = [
+        released_at - last_arrival[tick]
+        for samples in all_samples
+        for sample in samples
+        for tick, _arrived_at, released_at in sample["barriers"]
+    ]
+    summary = {"barrier_latency": barrier_latency}
+    for name in ["evaluate", "publish_fitness", "read_fitness", "fetch_parents"]:
+        summary[name] = [
+            sample[name] for samples in all_samples for sample in samples
+        ]
+
+    return {
+        name: {
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "max": float(np.max(values)),
+        }
+        for name, values in summary.items()
+    }
+
+
+def simulate(r, number_of_workers: int, args) -> dict:
+    r.flushall()
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=run_fake_worker,
+            args=(
+                index,
+                number_of_workers,
+                args.bots_per_worker,
+                args.generations,
+                args.genome_bytes,
+            ),
+        )
+        for index in range(number_of_workers)
+    ]
+    started_at = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started_at
+
+    all_samples = [json.loads(samples) for samples in r.lrange("simulation", 0, -1)]
+    if len(all_samples) < number_of_workers:
+        raise Exception(
+            f"Only {len(all_samples)} of {number_of_workers} fake workers finished"
+        )
+    return {
+        "workers": number_of_workers,
+        "seconds": seconds,
+        **summarize(all_samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--bots-per-worker", type=int, default=1)
+    parser.add_argument("--generations", type=int, default=3)
+    parser.add_argument("--genome-bytes", type=int, default=20_000)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    port = free_port()
+    stop_redis = start_redis(port)
+    # before the app modules are imported, so the forked workers use it
+    os.environ["REDIS_HOST"] = "127.0.0.1"
+    os.environ["REDIS_PORT"] = str(port)
+    os.environ["REDIS_IO_METRICS"] = "0"
+    from app.coordinator import r
+
+    results = []
+    try:
+        for number_of_workers in args.workers:
+            result = simulate(r, number_of_workers, args)
+            results.append(result)
+            print(
+                f"{number_of_workers:>5} workers: "
+                + ", ".join(
+                    f"{name} p50={result[name]['p50'] * 1000:.1f}ms "
+                    f"p95={result[name]['p95'] * 1000:.1f}ms"
+                    for name in [
+                        "barrier_latency",
+                        "publish_fitness",
+                        "read_fitness",
+                        "fetch_parents",
+                    ]
+                ),
+                flush=True,
+            )
+    finally:
+        stop_redis()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
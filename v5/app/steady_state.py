@@ -0,0 +1,207 @@
+import math
+import os
+import time
+
+from app.db import (
+    db_load_genomes,
+    db_publish_genomes,
+    db_read_genome_pool,
+)
+from app.metrics import metrics
+from app.publisher import Publisher
+from app.redis_io import redis_client
+from app.tetris_bot import TetrisBot
+from app.tetris_brain import TetrisBrain
+from app.worker_util import (
+    EventType,
+    events,
+    fitness_stats,
+    process_event,
+    weighted_selection,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+# How often the pool of finished genomes is re-read from Redis.
+POOL_REFRESH_SECONDS = float(os.getenv("POOL_REFRESH_SECONDS", 1.0))
+# Genomes older than this are no longer picked as parents.
+MAX_GENOME_AGE = float(os.getenv("MAX_GENOME_AGE", 300))
+# How long a bot's previous genome is kept once it publishes a new one, for
+# the workers whose copy of the pool still points at it.
+STALE_GENOME_TTL = math.ceil(3 * POOL_REFRESH_SECONDS)
+r = redis_client()
+
+
+class GenomePool:
+    """A local, slightly stale view of the steady-state pool in Redis.
+
+    The fitness values are re-read at most every POOL_REFRESH_SECONDS, and
+    the genomes themselves are cached by (bot id, version), as a published
+    version never changes.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.entries: list[tuple[int, int, float]] = []
+        self.refreshed_at = 0.0
+        self.genomes: dict[tuple[int, int], TetrisBrain] = {}
+
+    def refresh(self):
+        if time.time() - self.refreshed_at < POOL_REFRESH_SECONDS:
+            return
+        self.entries = db_read_genome_pool(r, MAX_GENOME_AGE)
+        self.refreshed_at = time.time()
+
+        # forget the genomes that have been replaced or have become too old
+        current = {(bot_id, version) for bot_id, version, _ in self.entries}
+        self.genomes = {
+            genome_key: brain
+            for genome_key, brain in self.genomes.items()
+            if genome_key in current
+        }
+
+    def select_parents(self, count: int) -> list[tuple[TetrisBrain, TetrisBrain]]:
+        """Pick count pairs of parents by weighted selection.
+
+        Returns fewer pairs if the pool doesn't have any usable genomes yet.
+        """
+        self.refresh()
+        all_fitness = [fitness for _, _, fitness in self.entries]
+        total_fitness = sum(all_fitness)
+        if total_fitness <= 0:
+            return []
+
+        genome_keys = [
+            (
+                self.entries[weighted_selection(all_fitness, total_fitness)][:2],
+                self.entries[weighted_selection(all_fitness, total_fitness)][:2],
+            )
+            for _ in range(count)
+        ]
+
+        missing = {
+            genome_key
+            for pair in genome_keys
+            for genome_key in pair
+            if genome_key not in self.genomes
+        }
+        for genome_key, brain_dict in db_load_genomes(r, list(missing)).items():
+            self.genomes[genome_key] = TetrisBrain.from_dict(
+                self.width, self.height, brain_dict
+            )
+
+        # genomes that expired before we got to them are skipped
+        return [
+            (self.genomes[parent_a], self.genomes[parent_b])
+            for parent_a, parent_b in genome_keys
+            if parent_a in self.genomes and parent_b in self.genomes
+        ]
+
+
+def end_bots_over_budget(
+    bots: list[TetrisBot],
+    ticks: dict[int, int],
+    started_at: dict[int, float],
+    max_ticks_per_bot: int,
+    max_seconds_per_bot: float,
+) -> int:
+    """End the game of every bot that has used up its ticks or seconds.
+
+    The bots keep the fitness they've earned so far, and are published and
+    replaced like the bots whose game is over.
+
+    Returns the number of bots that were ended.
+    """
+    now = time.time()
+    ended_bots = 0
+    for bot in bots:
+        if bot.engine.is_game_over:
+            continue
+        if (max_ticks_per_bot and ticks[bot.id] >= max_ticks_per_bot) or (
+            max_seconds_per_bot and now - started_at[bot.id] >= max_seconds_per_bot
+        ):
+            bot.engine.is_game_over = True
+            ended_bots += 1
+    return ended_bots
+
+
+def replace_finished_bots(bots: list[TetrisBot], pool: GenomePool) -> list[TetrisBot]:
+    """Publish the genomes of the bots that are game over, and restart them
+    with a child bred from the pool.
+
+    Returns the bots that were replaced.
+    """
+    finished_bots = [bot for bot in bots if bot.engine.is_game_over]
+    if not finished_bots:
+        return []
+
+    db_publish_genomes(
+        r,
+        finished_bots,
+        genome_ttl=int(MAX_GENOME_AGE * 2),
+        stale_genome_ttl=STALE_GENOME_TTL,
+    )
+
+    parents = pool.select_parents(len(finished_bots))
+    for bot in finished_bots:
+        if parents:
+            parent_a, parent_b = parents.pop()
+        else:
+            # the pool is still empty, so the child comes from the bot itself
+            parent_a = parent_b = bot.brain
+        bot.crossover_brains(parent_a, parent_b)
+        bot.reinit()
+
+    return finished_bots
+
+
+def run_steady_state(
+    bots: list[TetrisBot],
+    name: str,
+    publisher: Publisher,
+    max_ticks_per_bot: int = 0,
+    max_seconds_per_bot: float = 0,
+):
+    """Evolve the bots without a generation barrier.
+
+    A bot is replaced as soon as its game is over, so no worker ever waits
+    for another one. The per-generation budgets apply to every game, as a
+    bot that survives forever would never be published or bred from.
+    """
+    if not bots:
+        return
+    pool = GenomePool(bots[0].width, bots[0].height)
+    # of the game every bot is playing
+    ticks = {bot.id: 0 for bot in bots}
+    started_at = {bot.id: time.time() for bot in bots}
+
+    replaced_count = 0
+    while True:
+        for event in events:
+            process_event(bots, event)
+            if event == EventType.MEGATICK:
+                for bot in bots:
+                    ticks[bot.id] += 1
+            end_bots_over_budget(
+                bots, ticks, started_at, max_ticks_per_bot, max_seconds_per_bot
+            )
+
+            replaced_bots = replace_finished_bots(bots, pool)
+            for bot in replaced_bots:
+                ticks[bot.id] = 0
+                started_at[bot.id] = time.time()
+            replaced_count += len(replaced_bots)
+            metrics.inc("bots", len(replaced_bots))
+
+            # written in the background, so the bots never wait on Redis
+            with metrics.timer("to_dict"):
+                render_bots = [bot.to_dict() for bot in bots]
+            publisher.publish_frames(render_bots)
+
+        # log fitness stats about once per worker-sized batch of replacements
+        if replaced_count >= len(bots):
+            replaced_count = 0
+            all_fitness = [fitness for _, _, fitness in pool.entries] or [0]
+            fitness_stats(all_fitness)
+            metrics.publish(r, name)
@@ -1,6 +1,9 @@
+import time
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from app.metrics import metrics
 from app.tetris_brain import TetrisBrain, crossover, mutate
 from app.tetris_engine import TetrisEngine
 
@@ -28,6 +31,8 @@ class TetrisBot:
         self.engine = TetrisEngine(width, height)
         self.fitness = 0
         self.next_brain = None
+        # the last move, and the engine version it was decided for
+        self.decision: tuple[int, str] | None = None
         if brain is not None:
             self.brain = brain
         else:
@@ -68,21 +73,33 @@ class TetrisBot:
         if self.engine.is_game_over:
             return False
 
-        inputs = self.get_game_state_as_inputs().unsqueeze(0)  # Add batch dimension
+        started_at = time.perf_counter()
+        if self.decision is not None and self.decision[0] == self.engine.version:
+            # The brain is deterministic, so if the last move (e.g. a noop, or
+            # a left into a wall) didn't change the grid, it's made again.
+            # It still goes through the engine, which ends the game after too
+            # many repetitions.
+            move = self.decision[1]
+            metrics.inc("cached_decisions")
+        else:
+            inputs = self.get_game_state_as_inputs().unsqueeze(0)  # Add batch dimension
 
-        this = self
-        with torch.no_grad():
-            results = this.brain(inputs)
+            this = self
+            with torch.no_grad():
+                results = this.brain(inputs)
 
-        # Get the move with the highest probability
-        move_index = torch.argmax(results).item()
-        move = ["left", "right", "up", "down", "rotate_cw", "rotate_ccw", "noop"][
-            move_index
-        ]
+            # Get the move with the highest probability
+            move_index = torch.argmax(results).item()
+            move = ["left", "right", "up", "down", "rotate_cw", "rotate_ccw", "noop"][
+                move_index
+            ]
 
         # print(f"Bot {self.id} move: {move}, tick: {do_tick}")
 
+        thought_at = time.perf_counter()
+        version = self.engine.version
         self.engine.move_piece(move)
+        self.decision = (version, move) if self.engine.version == version else None
 
         # Incentivise movement
         if move != "noop":
@@ -94,10 +111,15 @@ class TetrisBot:
             self.engine.tick()
             self.fitness += self.engine.score_for_current_tick
 
+        metrics.add_time("inference", thought_at - started_at)
+        metrics.add_time("engine", time.perf_counter() - thought_at)
         return True
 
     def crossover(self, parent_a: "TetrisBot", parent_b: "TetrisBot") -> None:
-        child_brain = crossover(parent_a.brain, parent_b.brain)
+        self.crossover_brains(parent_a.brain, parent_b.brain)
+
+    def crossover_brains(self, brain_a: TetrisBrain, brain_b: TetrisBrain) -> None:
+        child_brain = crossover(brain_a, brain_b)
         mutate(child_brain, mutation_rate=0.01)
         self.next_brain = child_brain
 
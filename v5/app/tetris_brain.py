@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 
 
 class TetrisBrain(nn.Module):
@@ -26,6 +27,23 @@ class TetrisBrain(nn.Module):
         brain.load_state_dict(data)
         return brain
 
+    def to_vector(self) -> torch.Tensor:
+        """All weights and biases as one flat float32 tensor."""
+        return parameters_to_vector(self.parameters()).detach()
+
+    @classmethod
+    def from_vector(cls, width, height, vector):
+        brain = cls(width, height)
+        # copy, so the brain never shares memory with e.g. a memory-mapped file
+        vector = torch.tensor(vector, dtype=torch.float32)
+        vector_to_parameters(vector, brain.parameters())
+        return brain
+
+
+def state_dict_to_vector(data) -> torch.Tensor:
+    """The same flat tensor as TetrisBrain.to_vector, from a brain's to_dict()."""
+    return torch.cat([tensor.flatten() for tensor in data.values()])
+
 
 def crossover(parent_a, parent_b):
     child = TetrisBrain()
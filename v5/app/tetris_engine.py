@@ -1,6 +1,11 @@
+import itertools
 import random
 from typing import Dict, List, Optional, Tuple
 
+# Versions are unique across all engines in the process, so a version can't be
+# mistaken for one of a previous engine.
+_versions = itertools.count()
+
 
 class TetrisEngine:
     def __init__(
@@ -26,6 +31,8 @@ class TetrisEngine:
         self.wall_kick_cache: Dict[str, bool] = {}  # to prevent hovering pieces
         self.shapes: Dict[str, List[List[List[int]]]] = self.get_shapes()
         self.scores: List[int] = [0, 100, 300, 500, 800]
+        # changes whenever the grid is redrawn, see update_grid
+        self.version: int = next(_versions)
 
         if grid is None:
             self.generate_new_piece()  # Start with a piece
@@ -409,3 +416,4 @@ class TetrisEngine:
                             new_grid[y][x] = 1
 
         self.grid = new_grid
+        self.version = next(_versions)
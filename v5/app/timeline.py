@@ -0,0 +1,128 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import redis
+from app.redis_io import redis_client
+from dotenv import load_dotenv
+
+load_dotenv()
+# Spans are kept in the `trace` stream in Redis, trimmed to about this many
+# entries. 0 turns tracing off.
+TRACE_MAXLEN = int(os.getenv("TRACE_MAXLEN", 10000))
+TRACE_DIR = os.getenv("TRACE_DIR", "/usr/src/app/logs")
+
+
+class Tracer:
+    """Records the spans of a worker's phases, for a timeline of a generation.
+
+    Spans are buffered, and written to Redis in one pipeline per generation,
+    so tracing adds a single round trip to each generation.
+    """
+
+    def __init__(self):
+        self.spans: list[tuple[str, float, float]] = []
+
+    @contextmanager
+    def span(self, name: str):
+        if not TRACE_MAXLEN:
+            yield
+            return
+        # wall clock time, so the spans of all workers line up
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.time() - start))
+
+    def flush(self, r: redis.Redis, worker: int, generation: int):
+        """Write the spans recorded since the last flush under this generation."""
+        if not self.spans:
+            return
+        pipe = r.pipeline()
+        for name, start, duration in self.spans:
+            pipe.xadd(
+                "trace",
+                {
+                    "name": name,
+                    "worker": worker,
+                    "generation": generation,
+                    "start": start,
+                    "duration": duration,
+                },
+                maxlen=TRACE_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+        self.spans = []
+
+
+def to_chrome_trace(spans: list[dict]) -> dict:
+    """Chrome trace events for chrome://tracing or ui.perfetto.dev, one row per
+    worker."""
+    workers = sorted({span["worker"] for span in spans})
+    trace_events = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": 1,
+            "tid": worker,
+            "args": {"name": f"worker {worker}"},
+        }
+        for worker in workers
+    ]
+    for span in spans:
+        trace_events.append(
+            {
+                "name": span["name"],
+                "cat": "generation",
+                "ph": "X",
+                "pid": 1,
+                "tid": span["worker"],
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "args": {"generation": span["generation"]},
+            }
+        )
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def read_spans(r: redis.Redis) -> dict[int, list[dict]]:
+    """All the spans still in the stream, by generation."""
+    spans_by_generation: dict[int, list[dict]] = {}
+    for _entry_id, fields in r.xrange("trace"):
+        span = {key.decode("utf-8"): value for key, value in fields.items()}
+        span = {
+            "name": span["name"].decode("utf-8"),
+            "worker": int(span["worker"]),
+            "generation": int(span["generation"]),
+            "start": float(span["start"]),
+            "duration": float(span["duration"]),
+        }
+        spans_by_generation.setdefault(span["generation"], []).append(span)
+    return spans_by_generation
+
+
+def main(generations: list[int]):
+    """Write logs/trace-<generation>.json for the given generations, or for
+    every generation still in the stream."""
+    r = redis_client()
+    spans_by_generation = read_spans(r)
+    for generation in generations or sorted(spans_by_generation):
+        if generation not in spans_by_generation:
+            print(f"No spans for generation {generation}")
+            continue
+        path = os.path.join(TRACE_DIR, f"trace-{generation}.json")
+        with open(path, "w") as f:
+            json.dump(to_chrome_trace(spans_by_generation[generation]), f)
+        print(path)
+
+
+# One per process, like metrics.
+tracer = Tracer()
+
+
+if __name__ == "__main__":
+    main([int(generation) for generation in sys.argv[1:]])
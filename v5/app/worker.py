@@ -2,20 +2,48 @@ import asyncio
 import logging
 import os
 import socket
+import time
 import traceback
-from enum import Enum
-
-import redis
+from typing import Callable
+
+from app.archive import ARCHIVE_TOP_K, archive_generation
+from app.checkpoint import (
+    CHECKPOINT_EVERY,
+    RESUME_FROM,
+    Checkpoint,
+    load_checkpoint,
+    restore_rng_state,
+    save_checkpoint,
+    save_rng_state,
+)
 from app.coordinator import Coordinator
 from app.db import (
     db_load_all,
+    db_load_children,
     db_read_bots_fitness,
     db_save_all_dict,
+    db_save_children,
     db_write_bots_fitness,
 )
+from app.evaluation_pool import EVALUATION_PROCESSES, EvaluationPool
+from app.island import crossover_locally, migrate
+from app.metrics import metrics
+from app.profiler import Profiler
+from app.publisher import Publisher
+from app.records import GenerationLog
+from app.redis_io import redis_client
+from app.steady_state import run_steady_state
 from app.tetris_bot import TetrisBot
 from app.tetris_engine import TetrisEngine
-from app.worker_util import weighted_selection
+from app.timeline import tracer
+from app.worker_util import (
+    EventType,
+    events,
+    fitness_stats,
+    log,
+    process_event,
+    weighted_selection,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,30 +51,59 @@ logger = logging.getLogger(__name__)
 UNIQ = socket.gethostname()
 NUMBER_OF_WORKERS = int(os.getenv("NUMBER_OF_WORKERS", 1))
 BOTS_PER_WORKER = int(os.getenv("BOTS_PER_WORKER", 1))
-r = redis.Redis(host="redis", port=6379, db=0)
-
-
-class EventType(Enum):
-    TICK = "tick"
-    MEGATICK = "megatick"
-
-
-events = [EventType.TICK] * 8 + [EventType.MEGATICK] * 1
-
-
-def crossover_with_fittest(bots: list[TetrisBot]):
+# Per-generation budgets. When one is hit, the bots still alive keep the fitness
+# they have earned so far, and the generation ends. 0 means "no budget".
+MAX_TICKS_PER_BOT = int(os.getenv("MAX_TICKS_PER_BOT", 0))
+MAX_SECONDS_PER_GENERATION = float(os.getenv("MAX_SECONDS_PER_GENERATION", 0))
+# Fraction of this worker's bots that have to be game over to end the generation.
+GAME_OVER_QUORUM = float(os.getenv("GAME_OVER_QUORUM", 1.0))
+# The population size is fixed for the whole experiment, however many
+# workers it is split between.
+POPULATION_SIZE = NUMBER_OF_WORKERS * BOTS_PER_WORKER
+# "generational" (evaluate, barrier, crossover, barrier), "steady_state" or "island"
+EVOLUTION_MODE = os.getenv("EVOLUTION_MODE", "generational")
+# Stop after this many generations, e.g. for app/benchmark.py. 0 means never.
+MAX_GENERATIONS = int(os.getenv("MAX_GENERATIONS", 0))
+LOG_DIR = os.getenv("LOG_DIR", "/usr/src/app/logs")
+r = redis_client()
+publisher = Publisher(r)
+# started on first use, when EVALUATION_PROCESSES > 1
+evaluation_pool: EvaluationPool | None = None
+
+
+@metrics.timed("crossover")
+def crossover_with_fittest(
+    bots: list[TetrisBot],
+    generation: int,
+    read_fitness: Callable[[], list[float | None]] | None = None,
+    load_parents: Callable[[list[int]], list[TetrisBot]] | None = None,
+) -> dict:
+    """Breed the next brain of every bot from parents picked by fitness.
+
+    The fitness of the whole population and the parents from other workers
+    are read from Redis, unless read_fitness and load_parents are given, as
+    in app/local_runner.py.
+
+    Returns the fitness stats.
+    """
+    if read_fitness is None:
+        read_fitness = lambda: db_read_bots_fitness(
+            r, POPULATION_SIZE, f"bot_fitness:{generation}"
+        )
+    if load_parents is None:
+        load_parents = lambda bot_ids: db_load_all(r, bot_ids)
 
     # read fitness values for all bots (for all workers) from redis
     # log(f"worker bots fitness: {[bot.fitness for bot in bots]}")
-    all_fitness: list[float] = db_read_bots_fitness(
-        r, NUMBER_OF_WORKERS * BOTS_PER_WORKER
-    )
-    max_fitness = max(all_fitness)
-    min_fitness = min(all_fitness)
-    mean_fitness = sum(all_fitness) / len(all_fitness)
-    log(
-        f"max_fitness: {max_fitness}, min_fitness: {min_fitness}, mean_fitness: {mean_fitness}"
-    )
+    with tracer.span("fetch_fitness"):
+        all_fitness: list[float | None] = read_fitness()
+    # Bots of a worker that died mid-generation have no fitness,
+    # and with a fitness of 0 they will never be picked as parents.
+    missing_fitness = all_fitness.count(None)
+    if missing_fitness:
+        log(f"missing_fitness={missing_fitness}")
+        all_fitness = [fitness or 0.0 for fitness in all_fitness]
+    stats = fitness_stats(all_fitness)
 
     total_fitness = sum(all_fitness)
 
@@ -55,52 +112,115 @@ def crossover_with_fittest(bots: list[TetrisBot]):
     parent_ids_from_other_workers: set[int] = set()
     parent_pairs: list[tuple[int]] = []
 
-    for _i in range(len(bots)):
-        parent_a_id = weighted_selection(all_fitness, total_fitness)
-        parent_b_id = weighted_selection(all_fitness, total_fitness)
-        parent_pairs.append((parent_a_id, parent_b_id))
+    with metrics.timer("selection"):
+        for _i in range(len(bots)):
+            parent_a_id = weighted_selection(all_fitness, total_fitness)
+            parent_b_id = weighted_selection(all_fitness, total_fitness)
+            parent_pairs.append((parent_a_id, parent_b_id))
 
-        # if a parent is not in parent_bots (i.e. it's from another worker), add it to parent_ids_from_other_workers
-        if parent_a_id not in potential_parent_ids_from_this_worker:
-            parent_ids_from_other_workers.add(parent_a_id)
-        if parent_b_id not in potential_parent_ids_from_this_worker:
-            parent_ids_from_other_workers.add(parent_b_id)
+            # if a parent is not in parent_bots (i.e. it's from another worker), add it to parent_ids_from_other_workers
+            if parent_a_id not in potential_parent_ids_from_this_worker:
+                parent_ids_from_other_workers.add(parent_a_id)
+            if parent_b_id not in potential_parent_ids_from_this_worker:
+                parent_ids_from_other_workers.add(parent_b_id)
 
     # read other workers' bots from redis
     # log(f"crossover bots from other workers: {parent_ids_from_other_workers}")
-    parent_bots_from_other_workers: list[TetrisBot] = db_load_all(
-        r, list(parent_ids_from_other_workers)
-    )
+    with tracer.span("fetch_parents"):
+        parent_bots_from_other_workers: list[TetrisBot] = load_parents(
+            list(parent_ids_from_other_workers)
+        )
     parent_pool: list[TetrisBot] = bots + parent_bots_from_other_workers
     parent_pool_as_dict: dict[int, TetrisBot] = {bot.id: bot for bot in parent_pool}
 
     # log(f"parent_pool_as_dict: {parent_pool_as_dict.keys()}")
 
-    for idx in range(len(bots)):
-        bot = bots[idx]
-        parent_a_id, parent_b_id = parent_pairs[idx]
-        # log(f"bot {bot.id} parent_a_id={parent_a_id}, parent_b_id={parent_b_id}")
-        parent_a = parent_pool_as_dict[parent_a_id]
-        parent_b = parent_pool_as_dict[parent_b_id]
+    with metrics.timer("crossover_mutate"):
+        for idx in range(len(bots)):
+            bot = bots[idx]
+            parent_a_id, parent_b_id = parent_pairs[idx]
+            # log(f"bot {bot.id} parent_a_id={parent_a_id}, parent_b_id={parent_b_id}")
+            parent_a = parent_pool_as_dict[parent_a_id]
+            parent_b = parent_pool_as_dict[parent_b_id]
 
-        # Crossover the two parents to produce a new child brain.
-        # Even if parent_a and parent_b is the same brain, it will be slightly mutated
-        bot.crossover(parent_a, parent_b)
+            # Crossover the two parents to produce a new child brain.
+            # Even if parent_a and parent_b is the same brain, it will be slightly mutated
+            bot.crossover(parent_a, parent_b)
 
-    for bot in bots:
-        bot.reinit()
+    with metrics.timer("reinit"):
+        for bot in bots:
+            bot.reinit()
 
     # no need to save the bots here, as the new PyTorch weights will be local to the worker
     # and not needed in another worker.
 
+    return stats
 
-def bots_think_then_move(bots: list[TetrisBot]):
+
+@metrics.timed("evaluate")
+def bots_think_then_move(
+    bots: list[TetrisBot], generation: int, share_genomes: bool = True
+) -> dict:
+    """Play a generation until all bots are game over, or a budget is hit.
+
+    With share_genomes, the bots' brains and fitness are written to Redis
+    at the end, for crossover_with_fittest on every worker. All writes go
+    through the background publisher, so call publisher.flush() before
+    relying on them.
+
+    Returns the loop and event count of the last event.
+    """
+    global evaluation_pool
+
+    started_at = time.time()
+    moves_before = metrics.counter("moves")
+
+    if EVALUATION_PROCESSES > 1 and bots:
+        if evaluation_pool is None:
+            evaluation_pool = EvaluationPool(
+                EVALUATION_PROCESSES, POPULATION_SIZE, bots[0].width, bots[0].height
+            )
+        counts = evaluation_pool.evaluate(bots, publisher.publish_frames)
+    else:
+        counts = play_generation(bots, publish_render_frames)
+
+    if share_genomes:
+        # The bots don't change again until crossover, which is
+        # after the barrier the publisher is flushed before.
+        publisher.submit(lambda: save_genomes(bots, generation))
+
+    record_throughput(
+        len(bots),
+        metrics.counter("moves") - moves_before,
+        time.time() - started_at,
+    )
+    return counts
+
+
+def play_generation(
+    bots: list[TetrisBot],
+    on_frames: Callable[[list[TetrisBot]], None],
+    count_game_over: Callable[[], tuple[int, int]] | None = None,
+) -> dict:
+    """The game loop of bots_think_then_move, also run by the evaluation pool.
+
+    After every event, on_frames is called with the bots that played it.
+    GAME_OVER_QUORUM is checked against the game over and total bot counts
+    from count_game_over, which are those of bots by default, so the pool can
+    check it across all of the worker's bots rather than per shard.
+
+    Returns the loop and event count of the last event.
+    """
 
     # even though TetrisEngine has to_dict/from_dict, it's only used for rendering, and
     # we know we'll always need a fresh engine at this point
     for bot in bots:
         bot.engine = TetrisEngine(bot.width, bot.height)
 
+    started_at = time.time()
+    # Only the bots that are still playing are stepped and rendered. The list
+    # shrinks as games end, so the generation is over when it's empty.
+    alive_bots = list(bots)
     loop_count = 0
     while True:
         loop_count += 1
@@ -109,83 +229,298 @@ def bots_think_then_move(bots: list[TetrisBot]):
         for event in events:
             event_count += 1
 
-            process_event(bots, event)
+            # includes the bots whose game ends now, so their last frame is rendered
+            playing_bots = alive_bots
+            process_event(playing_bots, event)
+            alive_bots = [bot for bot in playing_bots if not bot.engine.is_game_over]
 
-            # check if all bots are game over
-            all_game_over = all(bot.engine.is_game_over for bot in bots)
+            all_game_over = not alive_bots
 
-            if all_game_over:
-                db_result = db_save_all_dict(
-                    r, [bot.to_dict(with_weights=False) for bot in bots], "render_bot"
+            cutoff = None
+            if not all_game_over:
+                game_over_count, bot_count = (
+                    count_game_over()
+                    if count_game_over
+                    else (len(bots) - len(alive_bots), len(bots))
                 )
-                if not db_result:
-                    raise Exception("Failed to save render_bots to Redis")
-                # use default key for bots with weights
-                db_result = db_save_all_dict(
-                    r, [bot.to_dict(with_weights=True) for bot in bots]
+                cutoff = generation_cutoff(
+                    game_over_count,
+                    bot_count,
+                    loop_count,
+                    event == EventType.MEGATICK,
+                    started_at,
                 )
-                if not db_result:
-                    raise Exception("Failed to save bots to Redis")
+                if cutoff:
+                    end_alive_bots(alive_bots)
+                    log(f"cutoff={cutoff}, alive_bots={len(alive_bots)}")
+
+            # We save bot state to Redis after every event, because the frontend will
+            # try and render the bot states 60 times a second, by reading
+            # from Redis via the "tick" websocket event.
+            # We could potentially optimise here by writing to Redis less frequently.
+            # E.g. whenever loop_count % N == 0 (every N loops)
+            # The bots that were already game over haven't changed since
+            # their last frame was saved.
+            on_frames(playing_bots)
+
+            if all_game_over or cutoff:
+                log(f"loop_count={loop_count}, event_count={event_count}")
+                return {"loop_count": loop_count, "event_count": event_count}
 
-                # write bot ids and fitness values to redis
-                db_write_bots_fitness(r, bots)
 
-                log(f"loop_count={loop_count}, event_count={event_count}")
-                return
-            else:
-
-                # We save bot state to Redis after every event, because the frontend will
-                # try and render the bot states 60 times a second, by reading
-                # from Redis via the "tick" websocket event.
-                # We could potentially optimise here by writing to Redis less frequently.
-                # E.g. whenever loop_count % N == 0 (every N loops)
-                db_result = db_save_all_dict(
-                    r, [bot.to_dict() for bot in bots], "render_bot"
-                )
-                if not db_result:
-                    raise Exception("Failed to save render_bots to Redis")
+def publish_render_frames(bots: list[TetrisBot]):
+    with metrics.timer("to_dict"):
+        render_bots = [bot.to_dict() for bot in bots]
+    publisher.publish_frames(render_bots)
+
+
+def save_genomes(bots: list[TetrisBot], generation: int):
+    # use default key for bots with weights
+    with metrics.timer("to_dict"):
+        weighted_bots = [bot.to_dict(with_weights=True) for bot in bots]
+    db_result = db_save_all_dict(r, weighted_bots)
+    if not db_result:
+        raise Exception("Failed to save bots to Redis")
+
+    # write bot ids and fitness values to redis
+    db_write_bots_fitness(r, bots, f"bot_fitness:{generation}")
 
 
-def process_event(bots: list[TetrisBot], event: EventType):
-    """For each bot, think and move based on the event.
+def record_throughput(bot_count: int, move_count: float, seconds: float):
+    metrics.inc("generations")
+    metrics.inc("bots", bot_count)
+    if seconds > 0:
+        metrics.set("bots_per_second", bot_count / seconds)
+        metrics.set("moves_per_second", move_count / seconds)
 
-    Returns nothing, as the bots are mutated in place.
+
+def generation_cutoff(
+    game_over_count: int,
+    bot_count: int,
+    loop_count: int,
+    did_tick: bool,
+    started_at: float,
+) -> str | None:
+    """Check the per-generation budgets.
+
+    Returns the name of the budget that was hit, or None if the generation
+    should carry on.
     """
-    do_tick = event == EventType.MEGATICK
+    # every loop ends with a megatick, so loop_count is the number of ticks per bot
+    if MAX_TICKS_PER_BOT and did_tick and loop_count >= MAX_TICKS_PER_BOT:
+        return f"max_ticks_per_bot={MAX_TICKS_PER_BOT}"
+
+    if (
+        MAX_SECONDS_PER_GENERATION
+        and time.time() - started_at >= MAX_SECONDS_PER_GENERATION
+    ):
+        return f"max_seconds_per_generation={MAX_SECONDS_PER_GENERATION}"
 
+    if GAME_OVER_QUORUM < 1.0 and game_over_count >= GAME_OVER_QUORUM * bot_count:
+        return f"game_over_quorum={GAME_OVER_QUORUM}"
+
+    return None
+
+
+def end_alive_bots(bots: list[TetrisBot]) -> int:
+    """End the game of every bot that is still alive.
+
+    The bots keep the fitness they've earned so far.
+
+    Returns the number of bots that were still alive.
+    """
+    alive_bots = 0
     for bot in bots:
-        # if bot.id == 0:
-        #     logging.info(f">bot_before: {bot}")
-        bot.think_then_move(do_tick)
-        # if bot.id == 0:
-        #     logging.info(f">bot_after: {bot}")
+        if not bot.engine.is_game_over:
+            bot.engine.is_game_over = True
+            alive_bots += 1
+    return alive_bots
+
+
+def rebalance_bots(
+    bots: list[TetrisBot],
+    bot_ids: list[int],
+    generation: int,
+    checkpoint: Checkpoint | None = None,
+) -> list[TetrisBot]:
+    """Keep the bots this worker still owns, and take over the rest of bot_ids.
+
+    Bots taken over from another worker are loaded from the checkpoint if
+    there is one, or else from the children bred in the last generation, or
+    else (if their worker died) from Redis with the brain they last played
+    with, or else created from scratch.
+    """
+    bots_by_id = {bot.id: bot for bot in bots}
+    new_bot_ids = [bot_id for bot_id in bot_ids if bot_id not in bots_by_id]
+    if new_bot_ids or len(bot_ids) != len(bots):
+        log(f"rebalance: bots={len(bot_ids)}, taken_over={len(new_bot_ids)}")
+
+    bot_opts = {"width": 10, "height": 10}
+    if checkpoint is not None:
+        for bot_id in new_bot_ids:
+            brain = checkpoint.brain(bot_id)
+            if brain is not None:
+                bots_by_id[bot_id] = TetrisBot(bot_id, brain=brain, **bot_opts)
+        new_bot_ids = [bot_id for bot_id in new_bot_ids if bot_id not in bots_by_id]
+
+    for bot in db_load_children(r, new_bot_ids, generation - 1):
+        bots_by_id[bot.id] = bot
+    new_bot_ids = [bot_id for bot_id in new_bot_ids if bot_id not in bots_by_id]
+
+    for bot in db_load_all(r, new_bot_ids):
+        bots_by_id[bot.id] = bot
+
+    return [
+        (
+            bots_by_id[bot_id]
+            if bot_id in bots_by_id
+            else TetrisBot(bot_id, **bot_opts)
+        )
+        for bot_id in bot_ids
+    ]
 
 
-def log(msg: str):
-    # print(msg, flush=True)
-    logging.info(msg)
+def record_generation(
+    generation: int, members: list[str], assignment: dict[str, list[int]]
+):
+    """Archive and checkpoint the population, on the leader only.
+
+    Called after every worker has saved its bots and fitness to Redis,
+    and before crossover.
+    """
+    if not ARCHIVE_TOP_K and not (
+        CHECKPOINT_EVERY and generation % CHECKPOINT_EVERY == 0
+    ):
+        return
+
+    all_fitness = db_read_bots_fitness(r, POPULATION_SIZE, f"bot_fitness:{generation}")
+
+    if ARCHIVE_TOP_K:
+        archive_generation(r, generation, all_fitness)
+
+    if CHECKPOINT_EVERY and generation % CHECKPOINT_EVERY == 0:
+        path = save_checkpoint(
+            r, generation, POPULATION_SIZE, all_fitness, members, assignment
+        )
+        log(f"checkpoint: path={path}")
 
 
 async def main():
     c = Coordinator(NUMBER_OF_WORKERS)
 
     logging.basicConfig(
-        filename=f"/usr/src/app/logs/worker-{c.id}.log", level=logging.INFO
+        filename=f"{LOG_DIR}/worker-{c.id}.log", level=logging.INFO
     )
+    generation_log = GenerationLog(f"{LOG_DIR}/generations-{c.id}.jsonl")
+    profiler = Profiler(r, c.id)
+
+    if EVOLUTION_MODE in ("steady_state", "island"):
+        # There are no barriers to rebalance at, so every worker keeps its
+        # own range of bot ids, labelled by its never-reused worker index.
+        bot_opts = {"width": 10, "height": 10}
+        bots = [
+            TetrisBot(bot_id + (c.id * BOTS_PER_WORKER), **bot_opts)
+            for bot_id in range(BOTS_PER_WORKER)
+        ]
+
+    if EVOLUTION_MODE == "steady_state":
+        run_steady_state(
+            bots, c.name, publisher, MAX_TICKS_PER_BOT, MAX_SECONDS_PER_GENERATION
+        )
+        return
+
+    if EVOLUTION_MODE == "island":
+        # the lease is only used to find the neighbouring islands
+        c.join()
+        generation = 0
+        while True:
+            generation += 1
+            profiler.before_generation(generation)
+            with tracer.span("evaluate"):
+                counts = bots_think_then_move(bots, generation, share_genomes=False)
+            with tracer.span("crossover"):
+                stats = crossover_locally(bots)
+            with tracer.span("migrate"):
+                migrate(bots, c.name, c.membership, generation)
+            for bot in bots:
+                bot.reinit()
+            profiler.after_generation()
+            metrics.publish(r, c.name)
+            tracer.flush(r, c.id, generation)
+            generation_log.append(
+                {"worker": c.id, "generation": generation, **stats, **counts}
+            )
+            if generation == MAX_GENERATIONS:
+                return
 
-    bot_opts = {"width": 10, "height": 10}
-    bots = [
-        TetrisBot(bot_id + (c.id * BOTS_PER_WORKER), **bot_opts)
-        for bot_id in range(BOTS_PER_WORKER)
-    ]
-    # log(f"worker bots={[bot.id for bot in bots]}")
-
-    tick = 1
+    # bots are assigned at the start of every generation, see rebalance_bots
+    bots: list[TetrisBot] = []
+
+    checkpoint = None
+    generation_offset = 0
+    if RESUME_FROM:
+        # All workers resume from the same checkpoint, even if "latest" moves
+        # on before a worker is scaled up.
+        r.set("resume_from", load_checkpoint(RESUME_FROM).path, nx=True)
+        checkpoint = load_checkpoint(r.get("resume_from").decode("utf-8"))
+        # the checkpointed genomes are played again, under their own generation
+        generation_offset = checkpoint.generation - 1
+        log(f"resume: checkpoint={checkpoint.path}")
+
+    first_tick = c.join()
+    if checkpoint is not None:
+        # Only the workers that start the resumed run play the checkpoint.
+        # Replicas scaled up later (with the same .env) take over their bots
+        # from Redis like any other late joiner, and keep their own RNG.
+        r.set("resume_tick", first_tick, nx=True)
+        if int(r.get("resume_tick")) != first_tick:
+            log(f"resume: joined at tick {first_tick}, not using the checkpoint")
+            checkpoint = None
+
+    tick = first_tick - 1
     while True:
-        await c.wait_for_all_workers(tick := tick + 1)
-        bots_think_then_move(bots)
-        await c.wait_for_all_workers(tick := tick + 1)
-        crossover_with_fittest(bots)
+        with tracer.span("barrier"):
+            # the others load the children of the bots they take over
+            publisher.flush()
+            await c.wait_for_all_workers(tick := tick + 1)
+        generation = tick // 2 + generation_offset
+        profiler.before_generation(generation)
+        members = c.members_at(tick)
+        assignment = c.assignment_at(tick, POPULATION_SIZE)
+        with tracer.span("rebalance"):
+            bots = rebalance_bots(
+                bots, assignment.get(c.name, []), generation, checkpoint
+            )
+        if checkpoint is not None:
+            if c.name in members:
+                restore_rng_state(checkpoint, members.index(c.name))
+            checkpoint = None
+
+        with tracer.span("evaluate"):
+            counts = bots_think_then_move(bots, generation)
+        if CHECKPOINT_EVERY:
+            save_rng_state(r, c.name, generation)
+
+        with tracer.span("barrier"):
+            # the others read this worker's genomes and fitness once it arrives
+            publisher.flush()
+            await c.wait_for_all_workers(tick := tick + 1)
+        if members and members[0] == c.name:
+            with tracer.span("record_generation"):
+                record_generation(generation, members, assignment)
+        with tracer.span("crossover"):
+            stats = crossover_with_fittest(bots, generation)
+        # Any of them may be taken over by another worker at the next
+        # generation, which can't be known until its barrier.
+        publisher.submit(lambda bots=bots: db_save_children(r, bots, generation))
+        profiler.after_generation()
+        metrics.publish(r, c.name)
+        tracer.flush(r, c.id, generation)
+        generation_log.append(
+            {"worker": c.id, "generation": generation, **stats, **counts}
+        )
+        if generation - generation_offset == MAX_GENERATIONS:
+            return
 
 
 if __name__ == "__main__":
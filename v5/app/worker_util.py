@@ -1,4 +1,17 @@
+import logging
 import random
+from enum import Enum
+
+from app.metrics import metrics
+from app.tetris_bot import TetrisBot
+
+
+class EventType(Enum):
+    TICK = "tick"
+    MEGATICK = "megatick"
+
+
+events = [EventType.TICK] * 8 + [EventType.MEGATICK] * 1
 
 
 def weighted_selection(all_fitness: list[float], total_fitness: float) -> int:
@@ -28,3 +41,39 @@ def weighted_selection(all_fitness: list[float], total_fitness: float) -> int:
     index -= 1  # Adjust index because we incremented it at the end of the loop
 
     return index
+
+
+def process_event(bots: list[TetrisBot], event: EventType):
+    """For each bot, think and move based on the event.
+
+    Returns nothing, as the bots are mutated in place.
+    """
+    do_tick = event == EventType.MEGATICK
+
+    moves = 0
+    with metrics.timer("think_then_move"):
+        for bot in bots:
+            # if bot.id == 0:
+            #     logging.info(f">bot_before: {bot}")
+            moves += bot.think_then_move(do_tick)
+            # if bot.id == 0:
+            #     logging.info(f">bot_after: {bot}")
+    metrics.inc("moves", moves)
+
+
+def fitness_stats(all_fitness: list[float]) -> dict:
+    """Log the fitness stats, in the format the worker logs always had."""
+    stats = {
+        "max_fitness": max(all_fitness),
+        "min_fitness": min(all_fitness),
+        "mean_fitness": sum(all_fitness) / len(all_fitness),
+    }
+    log(
+        f"max_fitness: {stats['max_fitness']}, min_fitness: {stats['min_fitness']}, mean_fitness: {stats['mean_fitness']}"
+    )
+    return stats
+
+
+def log(msg: str):
+    # print(msg, flush=True)
+    logging.info(msg)
@@ -37,9 +37,7 @@ function setup() {
 
 function draw() {
 
-    if (socket && socket.readyState === WebSocket.OPEN) {
-        socket.send("tick");  // Request the latest bot state
-    }
+    // the server pushes the latest bot state, see socket.onmessage
 
     // draw the game
     if (state) {